@@ -0,0 +1,158 @@
+"""Synthetic OCDS-like json and IATI-like xml files for the benchmarks.
+
+Files are made from a seeded random generator so the same size and seed
+always gives the same file, and are written a record at a time so large
+sizes do not need to fit in memory.
+"""
+import os
+import json
+import random
+import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+WORDS = (
+    "road school water health supply maintenance equipment services training "
+    "construction medical office cleaning software consulting transport food "
+    "security energy bridge clinic rural urban district national programme"
+).split()
+
+CURRENCIES = ["USD", "EUR", "GBP", "KES", "MXN"]
+COUNTRIES = ["KE", "UG", "TZ", "MX", "CO", "NP", "BD", "GH"]
+SECTORS = ["11220", "12220", "14030", "15110", "21020", "23230", "31120"]
+
+
+def words(rng, count):
+    return " ".join(rng.choice(WORDS) for num in range(count))
+
+
+def date(rng):
+    start = datetime.datetime(2015, 1, 1)
+    return (start + datetime.timedelta(minutes=rng.randrange(5_000_000))).isoformat() + "Z"
+
+
+def ocds_release(rng, num):
+    """One release with tender, awards, parties and items like an OCDS publisher's."""
+    ocid = f"ocds-bench-{num:08d}"
+    buyer = {"id": f"GB-BUYER-{rng.randrange(500)}", "name": words(rng, 3).title()}
+    suppliers = [
+        {"id": f"GB-SUPPLIER-{rng.randrange(5000)}", "name": words(rng, 2).title()}
+        for supplier in range(rng.randint(1, 3))
+    ]
+    currency = rng.choice(CURRENCIES)
+    items = [
+        {
+            "id": str(item),
+            "description": words(rng, 6),
+            "classification": {"scheme": "CPV", "id": str(rng.randrange(10000000, 99999999))},
+            "quantity": rng.randint(1, 500),
+            "unit": {"name": rng.choice(["item", "hour", "day", "kg"]),
+                     "value": {"amount": round(rng.uniform(1, 5000), 2), "currency": currency}},
+        }
+        for item in range(rng.randint(1, 5))
+    ]
+    return {
+        "ocid": ocid,
+        "id": f"{ocid}-{num}",
+        "date": date(rng),
+        "tag": [rng.choice(["tender", "award", "contract"])],
+        "initiationType": "tender",
+        "buyer": buyer,
+        "parties": [dict(party, roles=["supplier"]) for party in suppliers]
+        + [dict(buyer, roles=["buyer"])],
+        "tender": {
+            "id": f"{ocid}-tender",
+            "title": words(rng, 5).capitalize(),
+            "description": words(rng, 30),
+            "status": rng.choice(["active", "complete", "cancelled"]),
+            "value": {"amount": round(rng.uniform(1000, 10_000_000), 2), "currency": currency},
+            "procurementMethod": rng.choice(["open", "selective", "limited"]),
+            "items": items,
+            "tenderPeriod": {"startDate": date(rng), "endDate": date(rng)},
+        },
+        "awards": [
+            {
+                "id": f"{ocid}-award-{award}",
+                "status": "active",
+                "date": date(rng),
+                "value": {"amount": round(rng.uniform(1000, 10_000_000), 2), "currency": currency},
+                "suppliers": [supplier],
+            }
+            for award, supplier in enumerate(suppliers)
+        ],
+    }
+
+
+def write_ocds(file_name, size, seed=0):
+    """A release package with `size` releases under `releases`."""
+    rng = random.Random(seed)
+    with open(file_name, "w") as f:
+        f.write('{"uri": "https://example.com/bench.json", "publishedDate": "2024-01-01T00:00:00Z",'
+                ' "version": "1.1", "releases": [\n')
+        for num in range(size):
+            if num:
+                f.write(",\n")
+            f.write(json.dumps(ocds_release(rng, num)))
+        f.write("\n]}\n")
+
+
+def narrative(text):
+    return f"<narrative>{escape(text)}</narrative>"
+
+
+def iati_activity(rng, num):
+    """One iati-activity element with the parts most publishers use."""
+    currency = rng.choice(CURRENCIES)
+    org = f"XM-BENCH-{rng.randrange(300)}"
+    transactions = "".join(
+        f'<transaction><transaction-type code="{rng.choice([2, 3, 4])}"/>'
+        f'<transaction-date iso-date="{date(rng)[:10]}"/>'
+        f'<value currency="{currency}" value-date="{date(rng)[:10]}">{round(rng.uniform(100, 1_000_000), 2)}</value>'
+        f'<description>{narrative(words(rng, 6))}</description>'
+        f'<receiver-org ref={quoteattr(f"XM-RECEIVER-{rng.randrange(3000)}")}>{narrative(words(rng, 2).title())}'
+        "</receiver-org></transaction>"
+        for transaction in range(rng.randint(1, 6))
+    )
+    return (
+        f'<iati-activity last-updated-datetime="{date(rng)}" xml:lang="en" default-currency="{currency}">'
+        f"<iati-identifier>{org}-{num:08d}</iati-identifier>"
+        f'<reporting-org ref="{org}" type="10">{narrative(words(rng, 3).title())}</reporting-org>'
+        f"<title>{narrative(words(rng, 6).capitalize())}</title>"
+        f'<description type="1">{narrative(words(rng, 40))}</description>'
+        f'<participating-org ref="{org}" role="1">{narrative(words(rng, 3).title())}</participating-org>'
+        f'<activity-status code="{rng.randint(1, 5)}"/>'
+        f'<activity-date type="1" iso-date="{date(rng)[:10]}"/>'
+        f'<activity-date type="3" iso-date="{date(rng)[:10]}"/>'
+        f'<recipient-country code="{rng.choice(COUNTRIES)}" percentage="100"/>'
+        f'<sector vocabulary="1" code="{rng.choice(SECTORS)}" percentage="100"/>'
+        f'<budget type="1" status="1"><period-start iso-date="{date(rng)[:10]}"/>'
+        f'<period-end iso-date="{date(rng)[:10]}"/>'
+        f'<value currency="{currency}" value-date="{date(rng)[:10]}">{round(rng.uniform(1000, 5_000_000), 2)}</value>'
+        "</budget>"
+        f"{transactions}"
+        "</iati-activity>"
+    )
+
+
+def write_iati(file_name, size, seed=0):
+    """An iati-activities file with `size` activities."""
+    rng = random.Random(seed)
+    with open(file_name, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<iati-activities version="2.03" generated-datetime="2024-01-01T00:00:00Z">\n')
+        for num in range(size):
+            f.write(iati_activity(rng, num))
+            f.write("\n")
+        f.write("</iati-activities>\n")
+
+
+def data_file(data_dir, kind, size, seed=0):
+    """Path of the generated `kind` ("ocds" or "iati") file of `size`
+    records, made if it is not already in `data_dir`."""
+    os.makedirs(data_dir, exist_ok=True)
+    extension, write = {"ocds": ("json", write_ocds), "iati": ("xml", write_iati)}[kind]
+    file_name = os.path.join(data_dir, f"{kind}-{size}-{seed}.{extension}")
+    if not os.path.exists(file_name):
+        partial = file_name + ".partial"
+        write(partial, size, seed)
+        os.replace(partial, file_name)
+    return file_name
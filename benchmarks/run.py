@@ -0,0 +1,319 @@
+"""Benchmarks of loading, magic overhead and fetching results.
+
+Run from the top of the repository:
+
+    python -m benchmarks.run --sizes 1000,10000 --postgres postgresql:///postgres
+
+Each benchmark runs in a new process so its peak memory can be measured.
+Results are printed and saved as json in `benchmarks/results`, named by date
+and commit, and can be compared with an earlier run with `--compare`.
+"""
+import os
+import io
+import sys
+import json
+import time
+import platform
+import datetime
+import threading
+import tempfile
+import functools
+import resource
+import contextlib
+import subprocess
+import multiprocessing
+import concurrent.futures
+
+import click
+import pandas
+import sqlalchemy
+from IPython.testing.globalipapp import get_ipython
+
+import noteql
+from benchmarks.generate import data_file
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+MAGIC_CELLS = {
+    "magic_simple": ("value=CELL", "SELECT 1"),
+    "magic_jinja": ("value=CELL", "SELECT {{ number }} + 1"),
+    "magic_three_statements": (
+        "first=CELL",
+        "SELECT 1\n%%nql second=ROW\nSELECT 1, 2\n%%nql third=RECORDS\nSELECT {{ number }} a\n",
+    ),
+}
+
+
+def peak_mb():
+    # kilobytes on linux, bytes on mac.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def rss_mb():
+    """Resident memory now, or None where there is no /proc."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+class MemorySampler:
+    """Highest resident memory above that at the start, sampled on a thread.
+
+    The process peak includes importing everything, which is often more
+    than a small benchmark uses, so this is what the benchmark itself added.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = rss_mb()
+        self.highest = self.start
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            self.highest = max(self.highest, rss_mb())
+
+    def __enter__(self):
+        if self.start is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is None:
+            return
+        self.stop.set()
+        self.thread.join()
+        self.highest = max(self.highest, rss_mb())
+
+    @property
+    def extra_mb(self):
+        return None if self.start is None else self.highest - self.start
+
+
+def session(dburi, schema, **kw):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return noteql.Session(dburi, schema, **kw)
+
+
+def ingest_json(dburi, schema, size, data_dir):
+    file_name = data_file(data_dir, "ocds", size)
+    bench = session(dburi, schema)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = bench.load_json(file_name, path_to_list="releases", table_name="bench_releases", overwrite=True)
+    return time.perf_counter() - start, rows, os.path.getsize(file_name)
+
+
+def ingest_xml(dburi, schema, size, data_dir):
+    file_name = data_file(data_dir, "iati", size)
+    bench = session(dburi, schema)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = bench.load_xml(file_name, "iati-activity", table_name="bench_activities", overwrite=True)
+    return time.perf_counter() - start, rows, os.path.getsize(file_name)
+
+
+def fetch(dburi, schema, size, data_dir, arrow=False):
+    bench = session(dburi, schema, arrow=arrow)
+    start = time.perf_counter()
+    df = bench.get_dataframe("SELECT * FROM bench_fetch")
+    return time.perf_counter() - start, len(df), None
+
+
+def fetch_arrow(dburi, schema, size, data_dir):
+    return fetch(dburi, schema, size, data_dir, arrow=True)
+
+
+def fetch_csv(dburi, schema, size, data_dir):
+    bench = session(dburi, schema)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        file_name = os.path.join(tmpdirname, "fetch.csv")
+        start = time.perf_counter()
+        bench.export_csv("SELECT * FROM bench_fetch", file_name)
+        seconds = time.perf_counter() - start
+        return seconds, size, os.path.getsize(file_name)
+
+
+def magic(dburi, schema, size, data_dir, cell):
+    ip = get_ipython()
+    # the magics use the latest live session.
+    bench = session(dburi, schema, cell_magic_output=True)
+    ip.user_ns["number"] = 1
+    line, cell = MAGIC_CELLS[cell]
+    for num in range(10):
+        ip.run_cell_magic("nql", line, cell)
+    start = time.perf_counter()
+    for num in range(size):
+        ip.run_cell_magic("nql", line, cell)
+    seconds = time.perf_counter() - start
+    del bench
+    return seconds, size, None
+
+
+BENCHMARKS = {
+    "ingest_json": ingest_json,
+    "ingest_xml": ingest_xml,
+    "fetch_dataframe": fetch,
+    "fetch_arrow": fetch_arrow,
+    "fetch_csv": fetch_csv,
+}
+for name in MAGIC_CELLS:
+    BENCHMARKS[name] = functools.partial(magic, cell=name)
+
+
+def run_benchmark(name, dburi, schema, size, data_dir):
+    """Run one benchmark, in a process of its own, returning its metrics."""
+    with MemorySampler() as memory:
+        seconds, rows, size_bytes = BENCHMARKS[name](dburi, schema, size, data_dir)
+    result = {
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_second": rows / seconds if seconds else None,
+        "peak_mb": peak_mb(),
+        "extra_mb": memory.extra_mb,
+    }
+    if name in MAGIC_CELLS:
+        result["ms_per_cell"] = seconds / size * 1000
+    if size_bytes is not None:
+        result["mb_per_second"] = size_bytes / seconds / (1024 * 1024)
+    return result
+
+
+def isolated(*args):
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_benchmark, *args).result()
+
+
+def prepare_fetch(dburi, schema, size):
+    """Table of `size` rows of mixed types for the fetch benchmarks."""
+    bench = session(dburi, schema)
+    with contextlib.redirect_stdout(io.StringIO()):
+        bench.create_table(
+            "bench_fetch",
+            f"""
+            WITH RECURSIVE numbers(id) AS (
+                SELECT 1 UNION ALL SELECT id + 1 FROM numbers WHERE id < {int(size)}
+            )
+            SELECT id, id * 1.5 AS amount, 'title ' || id AS title, (id & 1) = 0 AS flag,
+                   '{{"id": ' || id || '}}' AS data
+            FROM numbers
+            """,
+        )
+    # duckdb files can only be open in one process.
+    bench.engine.dispose()
+
+
+def engines(tmpdirname, postgres):
+    """(name, dburi, schema) of each database to benchmark on."""
+    found = [("sqlite", f"sqlite:///{tmpdirname}/bench.sqlite", None)]
+    try:
+        import duckdb_engine  # noqa: F401
+
+        found.append(("duckdb", f"duckdb:///{tmpdirname}/bench.duckdb", None))
+    except ImportError:
+        print("duckdb_engine is not installed, skipping duckdb")
+    if postgres:
+        try:
+            session(postgres, "noteql_bench", drop_schema=True)
+            found.append(("postgres", postgres, "noteql_bench"))
+        except sqlalchemy.exc.OperationalError:
+            print(f"Could not connect to {postgres}, skipping postgres")
+    return found
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=HERE, check=True
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, cwd=HERE
+        ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def compare(results, previous_file):
+    with open(previous_file) as f:
+        previous = pandas.DataFrame(json.load(f)["results"])
+    keys = ["benchmark", "engine", "size"]
+    merged = pandas.DataFrame(results).merge(previous, on=keys, suffixes=("", "_before"))
+    merged["change"] = merged["seconds"] / merged["seconds_before"]
+    return merged[keys + ["seconds_before", "seconds", "change", "peak_mb_before", "peak_mb"]]
+
+
+@click.command()
+@click.option("--sizes", default="1000,10000,100000", help="comma separated record counts to benchmark")
+@click.option("--only", default="", help="comma separated benchmarks to run, all by default")
+@click.option("--postgres", default=lambda: os.environ.get("NOTEQL_BENCH_POSTGRES", "postgresql:///postgres"),
+              help="sqlalchemy uri of a postgres database, skipped if it can not connect")
+@click.option("--repeat", default=3, help="runs of each benchmark, the fastest is kept")
+@click.option("--magic-cells", default=500, help="cells run for each magic benchmark")
+@click.option("--data-dir", default=os.path.join(HERE, "data"), help="where generated files are kept")
+@click.option("--results-dir", default=os.path.join(HERE, "results"), help="where results are saved")
+@click.option("--compare", "previous_file", default=None, help="results file of an earlier run to compare with")
+def benchmark_command_line(sizes, only, postgres, repeat, magic_cells, data_dir, results_dir, previous_file):
+    sizes = [int(size) for size in sizes.split(",")]
+    names = only.split(",") if only else list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise click.BadParameter(f"unknown benchmarks {', '.join(sorted(unknown))}", param_hint="--only")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        for engine, dburi, schema in engines(tmpdirname, postgres):
+            for name in names:
+                for size in [magic_cells] if name in MAGIC_CELLS else sizes:
+                    if name.startswith("fetch"):
+                        prepare_fetch(dburi, schema, size)
+                    try:
+                        runs = [isolated(name, dburi, schema, size, data_dir) for num in range(repeat)]
+                    except Exception as e:
+                        # such as xml on a postgres built without libxml.
+                        print(f"{name} {engine} {size}: failed, {type(e).__name__}: {str(e).splitlines()[0]}")
+                        continue
+                    result = dict(min(runs, key=lambda run: run["seconds"]), benchmark=name, engine=engine, size=size)
+                    print(
+                        f"{name} {engine} {size}: {result['seconds']:0.4f} seconds, "
+                        f"{result['rows_per_second']:0.0f} rows/second, peak {result['peak_mb']:0.0f}MB"
+                        + ("" if result["extra_mb"] is None else f", {result['extra_mb']:0.0f}MB extra")
+                    )
+                    results.append(result)
+
+    commit, dirty = git_commit()
+    date = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    os.makedirs(results_dir, exist_ok=True)
+    results_file = os.path.join(results_dir, f"{date}-{commit or 'unknown'}{'-dirty' if dirty else ''}.json")
+    with open(results_file, "w") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "dirty": dirty,
+                "date": date,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "versions": {"sqlalchemy": sqlalchemy.__version__, "pandas": pandas.__version__},
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results saved to {results_file}")
+
+    with pandas.option_context("display.width", 200, "display.max_columns", 20):
+        columns = ["benchmark", "engine", "size", "seconds", "rows_per_second", "mb_per_second",
+                   "ms_per_cell", "peak_mb", "extra_mb"]
+        print(pandas.DataFrame(results).reindex(columns=columns).to_string(index=False))
+        if previous_file:
+            print(compare(results, previous_file).to_string(index=False))
+
+
+if __name__ == "__main__":
+    benchmark_command_line()
@@ -1,3 +1,4 @@
+import glob
 import noteql
 import click
 
@@ -10,12 +11,18 @@ import click
 @click.option('--dburi', default='', help='sqlalchemy db uri')
 @click.option('--append', is_flag=True, help='prefix')
 @click.option('--overwrite', is_flag=True, help='overwrite')
-@click.argument('file_name')
-def load_json_command_line(file_name, path, table, schema, field, dburi, append, overwrite):
-    if not schema:
-        schema = 'public'
-    session = noteql.Session(schema, dburi=dburi)
-    session.load_json(file_name, path_to_list=path, table_name=table, field_name=field, append=append, overwrite=overwrite)
+@click.option('--batch-size', default=10000, help='rows sent to the database at a time')
+@click.option('--connections', default=4, help='files loaded at once when given many files')
+@click.argument('file_names', nargs=-1, required=True)
+def load_json_command_line(file_names, path, table, schema, field, dburi, append, overwrite, batch_size, connections):
+    files = sorted(set(name for pattern in file_names for name in glob.glob(pattern) or [pattern]))
+    session = noteql.Session(dburi, schema or None)
+    if len(files) > 1:
+        session.load_many(files, path_to_list=path, table_name=table, field_name=field, append=append,
+                          overwrite=overwrite, batch_size=batch_size, connections=connections)
+        return
+    session.load_json(files[0], path_to_list=path, table_name=table, field_name=field, append=append, overwrite=overwrite,
+                      batch_size=batch_size)
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import glob
 import noteql
 import click
 
@@ -7,23 +8,45 @@ import click
 @click.option("--table", default="", help="tablename")
 @click.option("--schema", default="", help="schema")
 @click.option("--field", default="", help="fieldname in table")
+@click.option("--json-field", default="", help="also convert xml to json in this field")
 @click.option("--dburi", default="", help="sqlalchemy db uri")
 @click.option("--append", is_flag=True, help="prefix")
 @click.option("--overwrite", is_flag=True, help="overwrite")
-@click.argument("file_name")
+@click.option("--batch-size", default=1000, help="rows sent to the database at a time")
+@click.option("--workers", default=1, help="processes converting xml to json")
+@click.option("--connections", default=4, help="files loaded at once when given many files")
+@click.argument("file_names", nargs=-1, required=True)
 def load_xml_command_line(
-    file_name, tag, table, schema, field, dburi, append, overwrite
+    file_names, tag, table, schema, field, json_field, dburi, append, overwrite, batch_size, workers, connections
 ):
-    if not schema:
-        schema = "public"
-    session = noteql.Session(schema, dburi=dburi)
+    files = sorted(
+        set(name for pattern in file_names for name in glob.glob(pattern) or [pattern])
+    )
+    session = noteql.Session(dburi, schema or None)
+    if len(files) > 1:
+        session.load_many(
+            files,
+            connections=connections,
+            tag=tag,
+            table_name=table,
+            field_name=field,
+            json_field=json_field or None,
+            append=append,
+            overwrite=overwrite,
+            batch_size=batch_size,
+            workers=workers,
+        )
+        return
     session.load_xml(
-        file_name,
+        files[0],
         tag=tag,
         table_name=table,
         field_name=field,
+        json_field=json_field or None,
         append=append,
         overwrite=overwrite,
+        batch_size=batch_size,
+        workers=workers,
     )
 
 
@@ -1,26 +1,47 @@
 import sqlalchemy
 import ijson
 import os
+import glob
+import itertools
+import functools
+import collections
+import concurrent.futures
 import json
+import re
+import hashlib
 import decimal
 import datetime
+import weakref
 import lxml.etree
 import urllib.error
 import html
 import pandas
 import time
+import jinja2
 import jinjasql
 import xmltodict
 import pyparsing as pp
 import subprocess
-import openpyxl
+import sys
+import threading
+import contextlib
 from openpyxl.utils.dataframe import dataframe_to_rows
 
 from IPython.core.magic import Magics, magics_class, line_cell_magic
-from IPython.display import display, HTML
+from IPython.display import HTML
 from IPython import get_ipython
 from noteql.schema_queries import queries
-from urllib.parse import urlencode
+from noteql.loaders import Loader, loaders, batched, plain_query, write_csv
+from noteql.cache import ResultCache, references, relation_name, qualified_names
+from noteql.excel import ExcelWriter
+from noteql.datasette import DatasetteClient
+from noteql.parallel import display, ThreadStdout, dependencies, run_graph
+from noteql.timing import Timings, phase
+from noteql.plans import Plan, PlanHistory, sqlite_nodes
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 try:
     from jinja2.utils import markupsafe
     Markup = markupsafe.Markup
@@ -30,11 +51,42 @@ except Exception:
 
 LOCAL_DB_MADE = False
 
+# Weak references to live sessions in the order they were last set, most
+# recent last.
+SESSIONS = []
+
+JINJA_MARKERS = ("{{", "{%", "{#")
 
-def get_engine(dburi, connect_args=None):
+
+def get_engine(dburi, connect_args=None, pool_size=None, pre_ping=False):
     if not dburi:
         dburi = os.environ.get("NOTEQL_DBURI")
-    return sqlalchemy.create_engine(str(dburi), connect_args=connect_args or {})
+    url = sqlalchemy.engine.make_url(str(dburi))
+    engine_args = {"pool_pre_ping": pre_ping}
+    # sqlite files use a NullPool which does not take a size.
+    if pool_size and issubclass(url.get_dialect().get_pool_class(url), sqlalchemy.pool.QueuePool):
+        engine_args["pool_size"] = pool_size
+    return sqlalchemy.create_engine(url, connect_args=connect_args or {}, **engine_args)
+
+
+def setup_on_checkout(engine, statements):
+    """Run `statements` once on each new connection the first time it is
+    checked out of the pool of `engine`."""
+
+    def setup(dbapi_connection, connection_record, connection_proxy):
+        # info is cleared if the connection is remade after a disconnect.
+        if connection_record.info.get("noteql_setup"):
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+        dbapi_connection.commit()
+        connection_record.info["noteql_setup"] = True
+
+    sqlalchemy.event.listen(engine, "checkout", setup)
 
 
 def generate_rows(result, limit):
@@ -61,13 +113,73 @@ def put_quotes_round(table_name):
         return (None, double_quote(split[0]))
 
 
-def table_exists(connection, table, schema):
-    result = connection.execute(
-        "select exists(select * from information_schema.tables where table_name=%s and table_schema=%s)",
-        table,
-        schema,
-    )
-    return result.fetchall()[0][0]
+def iter_elements(f, tag):
+    """Yield each `tag` element from an xml file, freeing it once used.
+
+    The element and everything parsed before it are removed from the tree
+    after the caller has finished with it, so memory stays flat however
+    large the file is.
+    """
+    for action, elem in lxml.etree.iterparse(f, tag=tag):
+        yield elem
+        # a matching element inside another is still needed by its parent.
+        if next(elem.iterancestors(tag), None) is not None:
+            continue
+        elem.clear()
+        for ancestor in itertools.chain([elem], elem.iterancestors()):
+            while ancestor.getprevious() is not None:
+                del ancestor.getparent()[0]
+
+
+def xml_rows(xml_strings, context_json=None, json_field=False):
+    rows = []
+    for xml_string in xml_strings:
+        args = [xml_string]
+        if context_json:
+            args.append(context_json)
+        if json_field:
+            json_data = json.dumps(
+                xmltodict.parse(
+                    xml_string,
+                    force_cdata=True,
+                )
+            )
+            args.append(json_data)
+        rows.append(tuple(args))
+    return rows
+
+
+def ordered_pool_map(function, iterable, workers):
+    """Map `function` over `iterable` in a process pool, yielding in order.
+
+    At most two tasks per worker are in flight, so a slow consumer stops
+    the input being read ahead.
+    """
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def register_session(session):
+    unregister_session(session)
+    SESSIONS.append(weakref.ref(session))
+
+
+def unregister_session(session):
+    SESSIONS[:] = [ref for ref in SESSIONS if ref() not in (None, session)]
+
+
+def get_latest_session():
+    while SESSIONS:
+        session = SESSIONS[-1]()
+        if session is not None:
+            return session
+        SESSIONS.pop()
 
 
 def create_local_db():
@@ -112,6 +224,166 @@ def fields(values):
     return Markup(f"{fields}")
 
 
+class NamespaceTemplate(jinja2.Template):
+    """Template that renders from a mapping directly instead of copying it.
+
+    `Template.render` makes a dict of everything it is given, which for the
+    notebook namespace can be thousands of objects.
+    """
+
+    def render(self, context):
+        ctx = self.new_context(collections.ChainMap(context, self.globals), shared=True)
+        try:
+            return self.environment.concat(self.root_render_func(ctx))
+        except Exception:
+            self.environment.handle_exception()
+
+
+class ResultPreview:
+    """First page of the results of a query.
+
+    Only `page_size` rows, and one more to know if there are others, are
+    fetched and the cursor is closed, so the preview holds no transaction
+    or locks between cells. `next_page()` runs the query again with LIMIT
+    and OFFSET for the following page, so the pages only follow on from
+    each other when the query has an ORDER BY and its tables have not
+    changed. `total` counts the rows of the whole query the first time it
+    is used.
+    """
+
+    def __init__(self, session, sql, params=None, page_size=1000):
+        # the session holds the preview, a proxy so they do not keep each other alive.
+        self.session = weakref.proxy(session)
+        self.sql = plain_query(sql)
+        self.params = params
+        self.page_size = page_size
+        if session.datasette_url:
+            # nothing is held open on datasette so its pages are read as they are needed.
+            self.pages = session.datasette.iter_dataframes(
+                session.datasette.iter_pages(self.sql, params), page_size
+            )
+        else:
+            self.pages = self.iter_pages()
+        self.df = next(self.pages, None)
+        self._total = None
+
+    def iter_pages(self):
+        result = self.fetch(self.sql, self.page_size + 1)
+        if result is None:
+            return
+        offset = 0
+        while True:
+            headers, rows = result
+            with phase("dataframe"):
+                yield pandas.DataFrame.from_records(rows[:self.page_size], columns=headers)
+            if len(rows) <= self.page_size:
+                return
+            offset += self.page_size
+            result = self.fetch(
+                f"SELECT * FROM (\n{self.sql}\n) noteql_page LIMIT {self.page_size + 1} OFFSET {offset}",
+                self.page_size + 1,
+            )
+
+    def fetch(self, sql, size):
+        """Headers and up to `size` rows of `sql`, with the cursor closed and
+        the transaction ended, or None if it returns no rows.
+
+        Not `session.begin()` as that would close this preview.
+        """
+        args = [sql, self.params] if self.params else [sql]
+        with contextlib.ExitStack() as stack:
+            connection = self.session.free_connection()
+            if connection is None:
+                connection = stack.enter_context(self.session.engine.connect())
+            with connection.begin():
+                with phase("execute"):
+                    sql_result = self.session.streaming(connection, sql).execute(*args)
+                if not sql_result.returns_rows:
+                    return None
+                headers = list(sql_result.keys())
+                with phase("fetch"):
+                    rows = sql_result.fetchmany(size)
+                sql_result.close()
+        return headers, rows
+
+    def next_page(self):
+        """Next page of results or None when there are no more."""
+        return next(self.pages, None)
+
+    @property
+    def total(self):
+        if self._total is None:
+            count_sql = f"SELECT count(*) FROM (\n{self.sql}\n) noteql_count"
+            if self.session.datasette_url:
+                df = self.session.get_dataframe(count_sql, params=self.params, cache=False)
+                self._total = int(df.iloc[0, 0])
+            else:
+                self._total = self.fetch(count_sql, 1)[1][0][0]
+        return self._total
+
+    def close(self):
+        self.pages.close()
+
+
+class QueryHandle:
+    """A query running in the background, made by `Session.submit`.
+
+    `status` is one of pending, running, done, error or cancelled and
+    `elapsed` is the seconds it has been running for. `result()` waits for
+    the query and returns its dataframe or raises its error. `cancel()`
+    cancels the query on the database server if it has started.
+    """
+
+    def __init__(self, sql, loader=None):
+        self.sql = sql
+        self.loader = loader
+        self.future = None
+        self.started = None
+        self.finished = None
+        self.dbapi_connection = None
+        self.cancel_requested = False
+
+    @property
+    def status(self):
+        if self.future.cancelled():
+            return "cancelled"
+        if not self.future.done():
+            return "running" if self.started else "pending"
+        if self.future.exception():
+            return "cancelled" if self.cancel_requested else "error"
+        return "done"
+
+    @property
+    def elapsed(self):
+        if not self.started:
+            return 0
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def error(self):
+        if self.future.done() and not self.future.cancelled():
+            return self.future.exception()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """Cancel the query, returning False if it had already finished."""
+        if self.future.done():
+            return False
+        self.cancel_requested = True
+        if not self.future.cancel() and self.dbapi_connection is not None and self.loader:
+            self.loader.cancel(self.dbapi_connection)
+        return True
+
+    def __repr__(self):
+        first_line = self.sql.strip().split("\n")[0][:60]
+        return f"<QueryHandle {self.status} {self.elapsed:0.1f}s: {first_line}>"
+
+
 class Session:
     def __init__(
         self,
@@ -125,7 +397,21 @@ class Session:
         cell_magic_output=False,
         timer=False,
         magic_name=None,
-        connect_args=None
+        connect_args=None,
+        cache=False,
+        cache_size=256 * 1024 * 1024,
+        cache_dir=None,
+        chunksize=10000,
+        arrow=False,
+        preview_rows=1000,
+        datasette_workers=4,
+        persistent=False,
+        pool_size=None,
+        pre_ping=False,
+        settings=None,
+        async_workers=4,
+        plan_regression=1.5,
+        incremental=False,
     ):
         self.schema = schema
         self.dburi = dburi
@@ -136,15 +422,41 @@ class Session:
         self.cell_magic_output = cell_magic_output
 
         self.timer = timer
+        self.chunksize = chunksize
+        self.arrow = arrow
+        self.preview_rows = preview_rows
+        self.preview = None
+        self.workbooks = {}
+        self.persistent = persistent
+        self.pre_ping = pre_ping
+        self.settings = settings or {}
+        self.connection = None
+        self.connection_used = 0
+        self.ping_after = 30
+        self.thread = threading.current_thread()
+        self.async_workers = async_workers
+        self.executor = None
+        self.jobs = []
+        # the QueryHandle being run by a worker thread.
+        self.running = threading.local()
+        self.timings = Timings()
+        self.plans = PlanHistory(plan_regression)
+        self.incremental = incremental
+
+        self.cache = None
+        if cache or cache_dir:
+            self.cache = ResultCache(cache_size, cache_dir)
 
         if datasette_url:
             self.database_type = "datasette"
+            self.datasette = DatasetteClient(datasette_url, workers=datasette_workers)
         else:
-            self.engine = get_engine(dburi, connect_args)
+            self.engine = get_engine(dburi, connect_args, pool_size, pre_ping)
             # test connection
             with self.engine.begin() as connection:
                 pass
             self.database_type = self.engine.dialect.name
+            self.loader = loaders.get(self.database_type, Loader)
 
         param_style = "format"
         if self.database_type in ("sqlite", "duckdb"):
@@ -158,6 +470,10 @@ class Session:
         self.jinjarender.env.filters["i"] = identity
         self.jinjarender.env.filters["ident"] = identity
         self.jinjarender.env.filters["fields"] = fields
+        self.jinjarender.env.template_class = NamespaceTemplate
+        self.get_template = functools.lru_cache(maxsize=256)(
+            self.jinjarender.env.from_string
+        )
 
         self.overwrite = overwrite
         if schema:
@@ -170,6 +486,13 @@ class Session:
                     "create schema if not exists {};".format(self.schema)
                 )
 
+        if not datasette_url:
+            # after the schema is made as duckdb will not set a search path
+            # to a schema that does not exist.
+            setup_statements = self.loader.setup_statements(schema, self.settings)
+            if setup_statements:
+                setup_on_checkout(self.engine, setup_statements)
+
         self.ipython = get_ipython()
 
         if self.ipython and magic_name not in self.ipython.magics_manager.registry:
@@ -182,6 +505,8 @@ class Session:
         self.set()
 
     def tables(self):
+        if self.datasette_url:
+            return self.datasette.tables()
         database_queries = queries.get(self.database_type)
         if not database_queries:
             print(f"Database {self.database_type} not supported")
@@ -191,6 +516,8 @@ class Session:
         return self.get_dataframe(sql)
 
     def fields(self, table):
+        if self.datasette_url:
+            return self.datasette.fields(table)
         database_queries = queries.get(self.database_type)
         if not database_queries:
             print(f"Database {self.database_type} not supported")
@@ -210,19 +537,219 @@ class Session:
             f'Using db connection {connection} {"schema:" + self.schema if self.schema else ""}'
         )
         self.last_set = datetime.datetime.utcnow()
+        register_session(self)
+
+    def render(self, sql, context):
+        """Render the jinja in `sql` with `context`, returning sql and params.
+
+        `context` can be any mapping and is only read for the names the
+        template uses. Compiled templates are cached and sql with no jinja
+        markers is not rendered at all.
+        """
+        if not any(marker in sql for marker in JINJA_MARKERS):
+            # jinja would drop a single trailing newline.
+            return sql[:-1] if sql.endswith("\n") else sql, None
+        sql, params = self.jinjarender.prepare_query(self.get_template(sql), context)
+        return sql, params or None
+
+    def shared_connection(self):
+        """The session's own connection if it is `persistent`, or None.
+
+        It is only used from the thread that made the session. The
+        connection is remade if it was lost and, with `pre_ping`, checked
+        first if it has not been used for `ping_after` seconds.
+        """
+        if not self.persistent or threading.current_thread() is not self.thread:
+            return None
+        connection = self.connection
+        if connection is not None and (connection.closed or connection.invalidated):
+            connection.close()
+            connection = None
+        if (
+            connection is not None
+            and self.pre_ping
+            and not connection.in_transaction()
+            and time.monotonic() - self.connection_used > self.ping_after
+        ):
+            try:
+                with connection.begin():
+                    connection.execute("select 1")
+            except sqlalchemy.exc.DBAPIError as e:
+                if not e.connection_invalidated:
+                    raise
+                connection.close()
+                connection = None
+        if connection is None:
+            connection = self.connection = self.engine.connect()
+        self.connection_used = time.monotonic()
+        return connection
+
+    def free_connection(self):
+        """The shared connection if it is not in the middle of a transaction."""
+        connection = self.shared_connection()
+        if connection is not None and connection.in_transaction():
+            return None
+        return connection
+
+    def track(self, connection):
+        """Record the connection used by a background query so it can be cancelled."""
+        handle = getattr(self.running, "handle", None)
+        if handle is not None:
+            handle.dbapi_connection = connection.connection.dbapi_connection
+
+    @contextlib.contextmanager
+    def begin(self):
+        """Start a transaction, closing any open preview first.
+
+        Persistent sessions use their own connection if it is free.
+        """
+        if threading.current_thread() is self.thread:
+            self.close_preview()
+        connection = self.free_connection()
+        if connection is None:
+            with self.engine.begin() as connection:
+                self.track(connection)
+                yield connection
+        else:
+            with connection.begin():
+                yield connection
+
+    @contextlib.contextmanager
+    def connect(self):
+        if threading.current_thread() is self.thread:
+            self.close_preview()
+        connection = self.free_connection()
+        if connection is None:
+            with self.engine.connect() as connection:
+                self.track(connection)
+                yield connection
+        else:
+            yield connection
+
+    def database_per_thread(self):
+        """Whether each thread gets its own database, as with in memory SQLite,
+        so statements have to be run on the session's thread."""
+        return self.database_type == "sqlite" and isinstance(self.engine.pool, sqlalchemy.pool.SingletonThreadPool)
+
+    def streaming(self, connection, sql):
+        """`connection` set to fetch the results of `sql` as they are needed,
+        with a server side cursor on postgres, if `sql` is a query. Other
+        statements such as DDL and DML can not be run in a cursor."""
+        if plain_query(sql):
+            return connection.execution_options(stream_results=True)
+        return connection
+
+    def submit(self, sql, params=None, create=None, view=None, dataframe=None, cache=True, done=None, force=False):
+        """Run `sql` on a worker thread with its own connection, returning a
+        `QueryHandle` straight away.
+
+        `create` and `view` make a table or view from the query as the CREATE
+        and VIEW commands do. The query's dataframe is fetched if `dataframe`
+        is true, by default only when there is no table or view to make.
+        `force` rebuilds an incremental table even if it is up to date.
+        `done` is called with the handle when the query finishes. Up to
+        `async_workers` queries run at once.
+        """
+        if dataframe is None:
+            dataframe = not (create or view)
+        # running a query closes the preview, which the worker can not do.
+        self.close_preview()
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.async_workers, thread_name_prefix="noteql"
+            )
+        handle = QueryHandle(sql, getattr(self, "loader", None))
+        # the session's executor holds the function, a proxy so they do not keep each other alive.
+        session = weakref.proxy(self)
 
-    def get_results(self, sql, limit=-1, params=None, dataframe=False):
-        with self.engine.begin() as connection:
-            if self.schema:
-                connection.execute("set local search_path = {};".format(self.schema))
-            if params:
-                sql_result = connection.execute(sql, params)
-            else:
-                sql_result = connection.execute(sql)
+        def run():
+            session.running.handle = handle
+            handle.started = time.perf_counter()
+            try:
+                df = None
+                if dataframe:
+                    df = session.get_dataframe(sql, params=params, cache=cache)
+                if create:
+                    session.create_table(create, sql, params, force=force)
+                if view:
+                    if create:
+                        session.create_view(view, f"select * from {create}")
+                    else:
+                        session.create_view(view, sql, params)
+                return df
+            finally:
+                handle.finished = time.perf_counter()
+                session.running.handle = None
+
+        handle.future = self.executor.submit(run)
+        if done:
+            handle.future.add_done_callback(lambda future: done(handle))
+        self.jobs.append(handle)
+        return handle
+
+    def close(self):
+        """Close any preview and the connection of a persistent session, and
+        stop the magics using the session until its `set()` is called."""
+        unregister_session(self)
+        self.close_preview()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def close_preview(self):
+        if self.preview:
+            self.preview.close()
+            self.preview = None
+
+    def get_preview(self, sql, params=None, timer=False):
+        """Dataframe of the first `preview_rows` rows of `sql`.
+
+        The preview is kept on `session.preview` so more pages can be
+        fetched with `session.preview.next_page()` until another query is
+        run on this session. Statements that are not plain queries are run
+        once and all their rows returned.
+        """
+        if plain_query(sql) is None:
+            return self.get_dataframe(sql, params=params, timer=timer, cache=False)
+        with self.timings.query(sql, "preview") as timing:
+            preview = ResultPreview(self, sql, params, self.preview_rows)
+            if self.timer or timer:
+                print(timing.summary())
+        if preview.df is None:
+            return None
+        self.preview = preview
+        if len(preview.df) == self.preview_rows:
+            print(
+                f"Showing the first {self.preview_rows} rows. Use session.preview.next_page() for more "
+                "and session.preview.total for the number of rows."
+            )
+        return preview.df
+
+    def get_results(self, sql, limit=-1, params=None, dataframe=False, arrow=False):
+        if arrow and pyarrow is None:
+            raise ImportError("pyarrow needs to be installed to fetch results with arrow")
+        with self.begin() as connection:
+            loader = self.loader(connection)
+            if dataframe and arrow:
+                table = loader.fetch_arrow(sql, params)
+                self.invalidate_statement(sql)
+                if table is None:
+                    return None
+                with phase("dataframe"):
+                    return table.to_pandas(types_mapper=pandas.ArrowDtype)
+            with phase("execute"):
+                if params:
+                    sql_result = connection.execute(sql, params)
+                else:
+                    sql_result = connection.execute(sql)
+            self.invalidate_statement(sql)
             headers = sql_result.keys()
             if sql_result.returns_rows:
                 if dataframe:
-                    return pandas.DataFrame.from_records(sql_result, columns=headers)
+                    with phase("fetch"):
+                        rows = sql_result.fetchall()
+                    with phase("dataframe"):
+                        return pandas.DataFrame.from_records(rows, columns=headers)
                 else:
                     results = {
                         "data": [row for row in generate_rows(sql_result, limit)],
@@ -237,21 +764,85 @@ class Session:
         if results == "Success":
             return results
 
-    def create_table(self, table, sql, params=None):
-        return self.create_relation(table, sql, "TABLE", params)
-
-    def create_view(self, view, sql, params=None):
-        return self.create_relation(view, sql, "VIEW", params)
-
-    def create_relation(self, relation, sql, type, params=None):
-        if not (self.database_type == 'duckdb' and relation.startswith("'")):
-            self.run_sql(
-                """
-                DROP {type} IF EXISTS {relation};
-            """.format(
-                    relation=relation, type=type
-                )
+    def create_table(self, table, sql, params=None, force=False):
+        return self.create_relation(table, sql, "TABLE", params, force)
+
+    def create_view(self, view, sql, params=None, force=False):
+        return self.create_relation(view, sql, "VIEW", params, force)
+
+    def create_materialized_view(self, name, sql, params=None, unique=None):
+        """Materialized view of `sql` that is refreshed rather than dropped
+        when it is made again from the same sql.
+
+        `unique` is the comma separated columns of a unique index, which on
+        postgres lets it refresh concurrently without locking out readers.
+        Databases without materialized views get a table that is built under
+        a new name and swapped in.
+        """
+        with self.timings.query(sql, "create matview"):
+            self.invalidate(name)
+            with self.begin() as connection:
+                return self.loader(connection).create_materialized_view(name, sql, params, unique)
+
+    def create_relation(self, relation, sql, type, params=None, force=False):
+        with self.timings.query(sql, f"create {type.lower()}"):
+            if not self.incremental or relation.startswith("'"):
+                return self._create_relation(relation, sql, type, params)
+
+            up_to_date, fingerprint = self.up_to_date(relation, sql, params)
+            if up_to_date and not force:
+                print(f"{relation} is up to date, not rebuilt. Use FORCE to rebuild it.")
+                return "Skipped"
+            result = self._create_relation(relation, sql, type, params)
+            with self.begin() as connection:
+                self.loader(connection).set_build(relation_name(relation), fingerprint)
+            return result
+
+    def up_to_date(self, relation, sql, params=None):
+        """Whether `relation` exists and was last made by an incremental
+        CREATE or VIEW from `sql` and the same versions of the relations it
+        uses, along with the fingerprint of making it now."""
+        with self.begin() as connection, phase("fingerprint"):
+            loader = self.loader(connection)
+            relations = loader.relations()
+            fingerprint = self.build_fingerprint(loader, relations, relation, sql, params)
+            up_to_date = (
+                relation_name(relation) in map(relation_name, relations)
+                and self.last_build(loader, relations, relation) == fingerprint
             )
+        return up_to_date, fingerprint
+
+    def last_build(self, loader, relations, relation):
+        if loader.builds_table not in relations:
+            return None
+        return loader.get_build(relation_name(relation))
+
+    def build_fingerprint(self, loader, relations, relation, sql, params=None):
+        """Hash of the sql, params and, for every table or view that the sql
+        mentions, a version of its rows, a marker that changes when it is made
+        again and its own last build.
+
+        The rows' version is a checksum on SQLite and the row count elsewhere.
+        Tables in other schemas or attached databases count when the sql
+        names them with their schema.
+        """
+        versions = []
+        for name, marker in sorted(relations.items()):
+            if name == loader.builds_table or relation_name(name) == relation_name(relation):
+                continue
+            if references(sql, name):
+                versions.append([name, loader.content_version(name), marker, self.last_build(loader, relations, name)])
+        for name in sorted(qualified_names(sql)):
+            if name.replace('"', "").lower() != relation.replace('"', "").lower() and loader.relation_kind(name):
+                versions.append([name, loader.content_version(name), loader.relation_marker(name), None])
+        return hashlib.sha256(json.dumps([sql, repr(params), versions], default=str).encode()).hexdigest()
+
+    def _create_relation(self, relation, sql, type, params=None):
+        self.invalidate(relation)
+        if not (self.database_type == 'duckdb' and relation.startswith("'")):
+            # it could have been made as another type of relation before.
+            with self.begin() as connection:
+                self.loader(connection).drop_relation(relation)
 
             sql = """
                 CREATE {type} {relation}
@@ -285,30 +876,252 @@ class Session:
         index_col=None,
         params=None,
         timer=False,
+        cache=True,
+        arrow=None,
     ):
-        start = time.perf_counter()
-        if self.datasette_url:
-            url_params = {"_shape": "array", "sql": sql}
-            if params:
-                url_params.update(params)
+        with self.timings.query(sql, "get_dataframe") as timing:
+            return self._get_dataframe(sql, params, timer, cache, arrow, timing)
+
+    def _get_dataframe(self, sql, params, timer, cache, arrow, timing):
+        if arrow is None:
+            arrow = self.arrow
 
+        cache_key = None
+        if self.cache and cache and plain_query(sql):
+            cache_key = self.cache.key(
+                sql, params, self.schema, self.datasette_url or self.dburi, arrow
+            )
+            df = self.cache.get(cache_key)
+            if df is not None:
+                if self.timer or timer:
+                    print(timing.summary(" (cached)"))
+                return df
+
+        if self.datasette_url:
             try:
-                return pandas.read_json(f"{self.datasette_url}?{urlencode(url_params)}")
+                with phase("fetch"):
+                    df = self.datasette.get_dataframe(sql, params)
             except urllib.error.HTTPError as e:
                 print("Reponse error:", e.fp.read().decode())
                 raise
             finally:
                 if self.timer or timer:
-                    end = time.perf_counter()
-                    print(f"Query took {end - start:0.4f} seconds")
+                    print(timing.summary())
+        else:
+            df = self.get_results(sql, params=params, dataframe=True, arrow=arrow)
 
-        df = self.get_results(sql, params=params, dataframe=True)
+            if self.timer or timer:
+                print(timing.summary())
 
-        if self.timer or timer:
-            end = time.perf_counter()
-            print(f"Query took {start - end:0.4f} seconds")
+        if df is not None and cache_key:
+            self.cache.put(cache_key, sql, df.copy())
         return df
 
+    def get_rows(self, sql, params=None, limit=None, timer=False, cache=True):
+        """Headers and a list of row tuples for `sql` without making a dataframe.
+
+        Only `limit` rows are fetched from the database if given. Returns None
+        if the statement does not return rows.
+        """
+        if self.datasette_url or (self.cache and cache and plain_query(sql)):
+            df = self.get_dataframe(sql, params=params, timer=timer, cache=cache)
+            if df is None:
+                return None
+            if limit is not None:
+                df = df.head(limit)
+            return list(df.columns), list(df.itertuples(index=False, name=None))
+
+        with self.timings.query(sql, "get_rows") as timing, self.connect() as connection:
+            with connection.begin():
+                if limit is not None:
+                    # so postgres only sends the rows asked for.
+                    connection = self.streaming(connection, sql)
+                with phase("execute"):
+                    if params:
+                        sql_result = connection.execute(sql, params)
+                    else:
+                        sql_result = connection.execute(sql)
+                self.invalidate_statement(sql)
+                if not sql_result.returns_rows:
+                    return None
+                headers = list(sql_result.keys())
+                with phase("fetch"):
+                    if limit is None:
+                        rows = sql_result.fetchall()
+                    else:
+                        rows = sql_result.fetchmany(limit)
+                    sql_result.close()
+
+            if self.timer or timer:
+                print(timing.summary())
+            return headers, [tuple(row) for row in rows]
+
+    def export_csv(self, sql, file_name, params=None, timer=False):
+        """Write the results of `sql` to the csv file `file_name` without
+        loading them into a dataframe.
+
+        Postgres streams the rows with COPY TO STDOUT and DuckDB writes the
+        file itself, other databases write `chunksize` rows at a time. The
+        file is gzipped if its name ends in `.gz`.
+        """
+        if self.datasette_url:
+            df = self.get_dataframe(sql, params=params, timer=timer)
+            if df is not None:
+                df.to_csv(file_name, index=False)
+            return
+
+        with self.timings.query(sql, "export_csv") as timing:
+            with self.begin() as connection, phase("export"):
+                self.loader(connection).export_csv(sql, file_name, params, self.chunksize)
+            self.invalidate_statement(sql)
+            if self.timer or timer:
+                print(timing.summary())
+
+    def iter_rows(self, sql, params=None, timer=False):
+        """Yield a tuple of the headers of `sql` then a tuple for each row.
+
+        Rows are fetched `chunksize` at a time as they are needed. Nothing is
+        yielded if the statement does not return rows.
+        """
+
+        def done(timing):
+            if self.timer or timer:
+                print(timing.summary())
+
+        return self.timings.iterate(sql, "iter_rows", self._iter_rows(sql, params), done)
+
+    def _iter_rows(self, sql, params=None):
+        if self.datasette_url:
+            with phase("fetch"):
+                pages = self.datasette.iter_pages(sql, params)
+                headers = next(pages)
+            yield tuple(headers)
+            while True:
+                with phase("fetch"):
+                    rows = next(pages, None)
+                if rows is None:
+                    return
+                for row in rows:
+                    yield tuple(row)
+
+        with self.connect() as connection:
+            with connection.begin():
+                connection = self.streaming(connection, sql)
+                with phase("execute"):
+                    if params:
+                        sql_result = connection.execute(sql, params)
+                    else:
+                        sql_result = connection.execute(sql)
+                self.invalidate_statement(sql)
+                if not sql_result.returns_rows:
+                    return
+                yield tuple(sql_result.keys())
+                while True:
+                    with phase("fetch"):
+                        rows = sql_result.fetchmany(self.chunksize)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield tuple(row)
+
+    def excel_workbook(self, file_name):
+        """Collect the sheets of every `EXCEL file_name` from any cell into one
+        workbook until its `save()` is called or its `with` block ends."""
+        path = os.path.abspath(file_name)
+        workbooks = self.workbooks
+        writer = ExcelWriter(file_name, on_save=lambda writer: workbooks.pop(path, None))
+        workbooks[path] = writer
+        return writer
+
+    def iter_dataframes(self, sql, chunksize=None, params=None):
+        """Yield the results of `sql` as dataframes of up to `chunksize` rows.
+
+        Rows are fetched as they are needed, using a server side cursor on
+        postgres, so only one chunk is held in memory. The connection is held
+        until the generator is finished or closed.
+        """
+        chunksize = chunksize or self.chunksize
+        if self.datasette_url:
+            yield from self.datasette.iter_dataframes(self.datasette.iter_pages(sql, params), chunksize)
+            return
+
+        with self.connect() as connection:
+            with connection.begin():
+                connection = self.streaming(connection, sql)
+                with phase("execute"):
+                    if params:
+                        sql_result = connection.execute(sql, params)
+                    else:
+                        sql_result = connection.execute(sql)
+                self.invalidate_statement(sql)
+                if not sql_result.returns_rows:
+                    return
+                headers = list(sql_result.keys())
+                while True:
+                    with phase("fetch"):
+                        rows = sql_result.fetchmany(chunksize)
+                    if not rows:
+                        break
+                    with phase("dataframe"):
+                        df = pandas.DataFrame.from_records(rows, columns=headers)
+                    yield df
+
+    def explain(self, sql, params=None, analyze=False):
+        """Plan of `sql` from the database's EXPLAIN, kept in `session.plans`.
+
+        With `analyze` the query is run, in a transaction that is rolled
+        back, to get actual times. A warning is printed if the estimated
+        cost or actual time is more than `plan_regression` times that of the
+        last plan of the same query.
+        """
+        with self.timings.query(sql, "analyze" if analyze else "explain"):
+            if self.datasette_url:
+                with phase("execute"):
+                    nodes = sqlite_nodes(
+                        self.datasette.query("explain query plan " + sql, params)["rows"]
+                    )
+                    seconds = None
+                    if analyze:
+                        start = time.perf_counter()
+                        self.datasette.get_dataframe(sql, params)
+                        seconds = time.perf_counter() - start
+                plan = Plan(sql, nodes, time=seconds, analyze=analyze)
+            else:
+                with self.connect() as connection, phase("execute"):
+                    transaction = connection.begin()
+                    try:
+                        plan = self.loader(connection).explain(sql, params, analyze)
+                    finally:
+                        transaction.rollback()
+
+        for regression in self.plans.add(plan):
+            print(f"WARNING: plan regression for query {plan.fingerprint}, {regression}")
+        return plan
+
+    def stats(self):
+        """Count, total, mean, p50, p90, p99 and max seconds of each phase of
+        the queries run by this session, grouped by query fingerprint."""
+        return self.timings.stats()
+
+    def add_timing_hook(self, hook):
+        """Call `hook` with the `QueryTiming` of every query when it finishes."""
+        self.timings.hooks.append(hook)
+
+    def invalidate(self, relation=None):
+        """Remove cached results that use `relation`, or all of them if not given."""
+        if not self.cache:
+            return
+        if relation:
+            self.cache.invalidate(relation)
+        else:
+            self.cache.clear()
+
+    def invalidate_statement(self, sql):
+        """Remove all cached results unless `sql` is a plain query, as other
+        statements, even ones returning rows, could have changed anything."""
+        if plain_query(sql) is None:
+            self.invalidate()
+
     def show_dataframe(self, sql, title=None, title_size="h3", **kwargs):
         if title:
             self.show_title(title, title_size)
@@ -331,6 +1144,7 @@ class Session:
         field_name=None,
         append=False,
         overwrite=None,
+        batch_size=10000,
     ):
         file_object = False
         if hasattr(json_file, "read"):
@@ -350,17 +1164,16 @@ class Session:
             field_name = path_to_list.split(".")[-1] or "json"
         schema_name, table_name = put_quotes_round(table_name)
         if schema_name is None:
-            schema_name = double_quote(self.schema)
+            schema_name = double_quote(self.schema) if self.schema else None
             full_name = table_name
         else:
             full_name = schema_name + "." + table_name
 
-        with self.engine.begin() as connection:
-            if self.schema:
-                connection.execute("set local search_path = {};".format(self.schema))
+        with self.timings.query(f"load_json {full_name}", "load_json"), self.begin() as connection:
+            loader = self.loader(connection)
             # remove quotes when looking at actual table.
             if (
-                table_exists(connection, table_name[1:-1], schema_name[1:-1])
+                loader.table_exists(table_name[1:-1], schema_name and schema_name[1:-1])
                 and not overwrite
                 and not append
             ):
@@ -369,39 +1182,36 @@ class Session:
                 )
                 return
             if not append:
-                connection.execute("drop table if exists {}".format(full_name))
+                loader.drop_table(full_name)
 
-            connection.execute(
-                'create table if not exists {}(id serial, "{}" jsonb)'.format(
-                    full_name, field_name
-                )
+            loader.create_table(
+                full_name, [(field_name, loader.json_type)], with_id=True
             )
 
             def load(f):
                 if single_cell:
-                    connection.execute(
-                        "insert into {}({}) values (%s)".format(full_name, field_name),
-                        f.read(),
-                    )
-                    print("Total rows loaded 1")
-                    return
-                num = -1
-                for num, item in enumerate(
-                    ijson.items(
-                        f, path_to_list + ("." if path_to_list else "") + "item"
-                    )
-                ):
-                    connection.execute(
-                        "insert into {}({}) values (%s)".format(full_name, field_name),
-                        json.dumps(item, cls=DecimalEncoder),
+                    rows = [(f.read(),)]
+                else:
+                    rows = (
+                        (json.dumps(item, cls=DecimalEncoder),)
+                        for item in ijson.items(
+                            f, path_to_list + ("." if path_to_list else "") + "item"
+                        )
                     )
-                print("Total rows loaded {}".format(num + 1))
+                return loader.insert_rows(full_name, [field_name], rows, batch_size)
 
-            if file_object:
-                load(json_file)
-            else:
+            total = None
+            if not file_object and not single_cell and not path_to_list:
+                total = loader.load_json_array(full_name, field_name, json_file)
+
+            if total is None and file_object:
+                total = load(json_file)
+            elif total is None:
                 with open(json_file) as f:
-                    load(f)
+                    total = load(f)
+            print("Total rows loaded {}".format(total))
+            self.invalidate(full_name)
+            return total
 
     def load_xml(
         self,
@@ -414,6 +1224,8 @@ class Session:
         json_field=None,
         append=False,
         overwrite=None,
+        batch_size=1000,
+        workers=None,
     ):
         if overwrite is None:
             overwrite = self.overwrite
@@ -423,16 +1235,15 @@ class Session:
             field_name = tag
         schema_name, table_name = put_quotes_round(table_name)
         if schema_name is None:
-            schema_name = double_quote(self.schema)
+            schema_name = double_quote(self.schema) if self.schema else None
             full_name = table_name
         else:
             full_name = schema_name + "." + table_name
 
-        with self.engine.begin() as connection:
-            if self.schema:
-                connection.execute("set local search_path = {};".format(self.schema))
+        with self.timings.query(f"load_xml {full_name}", "load_xml"), self.begin() as connection:
+            loader = self.loader(connection)
             if (
-                table_exists(connection, table_name[1:-1], schema_name[1:-1])
+                loader.table_exists(table_name[1:-1], schema_name and schema_name[1:-1])
                 and not overwrite
                 and not append
             ):
@@ -441,48 +1252,120 @@ class Session:
                 )
                 return
             if not append:
-                connection.execute("drop table if exists {}".format(full_name))
+                loader.drop_table(full_name)
 
-            extra_create = ""
-            extra_params = ""
+            columns = [(field_name, loader.xml_type)]
             if context:
-                extra_create += ", {} JSONB".format(context_name)
-                extra_params += ", %s"
+                columns.append((context_name, loader.json_type))
             if json_field:
-                extra_create += ", {} JSONB".format(json_field)
-                extra_params += ", %s"
+                columns.append((json_field, loader.json_type))
 
-            connection.execute(
-                'create table if not exists {}("{}" xml {})'.format(
-                    full_name, field_name, extra_create
-                )
+            loader.create_table(full_name, columns)
+
+            make_rows = functools.partial(
+                xml_rows,
+                context_json=json.dumps(context) if context else None,
+                json_field=bool(json_field),
             )
 
-            all_rows = []
+            def rows(f):
+                xml_strings = (
+                    lxml.etree.tostring(elem, encoding="unicode")
+                    for elem in iter_elements(f, tag)
+                )
+                # elements can not be sent to other processes so only the
+                # xmltodict conversion is done in the pool.
+                chunks = batched(xml_strings, 100)
+                if workers and workers > 1 and json_field:
+                    converted = ordered_pool_map(make_rows, chunks, workers)
+                else:
+                    converted = map(make_rows, chunks)
+                for chunk_rows in converted:
+                    yield from chunk_rows
+
             with open(file_name, "rb") as f:
-                tree = lxml.etree.iterparse(f, tag=tag)
-                num = 0
-                for action, elem in tree:
-                    num += 1
-                    xml_string = lxml.etree.tostring(elem, encoding="unicode")
-                    args = [xml_string]
-                    if context:
-                        args.append(json.dumps(context))
-                    if json_field:
-                        json_data = json.dumps(
-                            xmltodict.parse(
-                                xml_string,
-                                force_cdata=True,
-                            )
-                        )
-                        args.append(json_data)
-                    all_rows.append(tuple(args))
-            if all_rows:
-                connection.execute(
-                    "insert into {} values (%s {})".format(full_name, extra_params),
-                    *all_rows,
+                num = loader.insert_rows(
+                    full_name, [name for name, type in columns], rows(f), batch_size
                 )
             print("Total rows loaded {}".format(num))
+            self.invalidate(full_name)
+            return num
+
+    def load_many(
+        self, files, table_name=None, connections=4, append=False, overwrite=None, **kwargs
+    ):
+        """Load many json or xml files into one table.
+
+        `files` is a list of file names or a glob pattern. Files ending in
+        `.xml` are loaded with `load_xml` and others with `load_json`, extra
+        keyword arguments are passed on to them. The first file makes the
+        table then the rest are appended, each in its own transaction, using
+        up to `connections` connections at once. If the first file fails the
+        rest are skipped. Returns a dataframe with the rows loaded, time
+        taken and any error for each file.
+        """
+        if isinstance(files, str):
+            files = sorted(glob.glob(files))
+        if not files:
+            print("No files to load")
+            return
+        if not table_name:
+            table_name = os.path.split(files[0])[1].split(".")[0]
+        if self.database_type != "postgresql":
+            # sqlite and duckdb only allow one writer at a time.
+            connections = 1
+
+        def load_file(file_name, **options):
+            start = time.perf_counter()
+            if file_name.lower().endswith(".xml"):
+                load = self.load_xml
+            else:
+                load = self.load_json
+            rows, error = None, None
+            try:
+                rows = load(file_name, table_name=table_name, **kwargs, **options)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                print(f"Error loading {file_name}: {error}")
+            return {
+                "file": file_name,
+                "rows": rows,
+                "seconds": time.perf_counter() - start,
+                "error": error,
+            }
+
+        start = time.perf_counter()
+        first = load_file(files[0], append=append, overwrite=overwrite)
+        if first["rows"] is None and not first["error"]:
+            # table already exists, load_file has printed a warning.
+            return
+        results = [first]
+
+        load_rest = functools.partial(load_file, append=True)
+        if first["error"]:
+            # the table was not made, or is still the old one, so nothing is appended to it.
+            print(f"Not loading the other files as the first, {files[0]}, failed")
+            results.extend(
+                {"file": file_name, "rows": None, "seconds": 0, "error": f"Skipped as {files[0]} failed"}
+                for file_name in files[1:]
+            )
+        elif connections > 1:
+            with concurrent.futures.ThreadPoolExecutor(connections) as executor:
+                results.extend(executor.map(load_rest, files[1:]))
+        else:
+            results.extend(map(load_rest, files[1:]))
+
+        seconds = time.perf_counter() - start
+        report = pandas.DataFrame(results, columns=["file", "rows", "seconds", "error"])
+        total_rows = int(report["rows"].fillna(0).sum())
+        failed = int(report["error"].notnull().sum())
+        print(
+            f"Loaded {len(files) - failed} of {len(files)} files, {total_rows} rows "
+            f"in {seconds:0.2f} seconds ({total_rows / seconds:0.0f} rows/sec)"
+        )
+        if failed:
+            print(f"{failed} files failed, see the error column")
+        return report
 
     def load_dataframe(
         self,
@@ -495,9 +1378,7 @@ class Session:
         dtype=None,
         method=None,
     ):
-        with self.engine.begin() as connection:
-            if self.schema:
-                connection.execute("set local search_path = {};".format(self.schema))
+        with self.begin() as connection:
             dataframe.to_sql(
                 table_name,
                 connection,
@@ -508,6 +1389,7 @@ class Session:
                 dtype=dtype,
                 method=method,
             )
+        self.invalidate(table_name)
 
     def add_flatten_function(self):
         self.run_sql(
@@ -589,96 +1471,141 @@ class DecimalEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-@magics_class
-class Noteql(Magics):
-    def get_parsers(self, noteql_session):
-        arg_params = (
-            pp.Word(pp.alphanums + "_")
+@functools.lru_cache(maxsize=None)
+def make_parsers(magic_name):
+    """Build the `%%magic_name` line and cell grammars, cached per magic name."""
+    arg_params = (
+        pp.Word(pp.alphanums + "_")
+        + pp.Suppress("=")
+        + pp.QuotedString("'", escQuote="'")
+    )("arg_params")
+
+    create = pp.Keyword("create", caseless=True).suppress() + (
+        pp.Word(pp.alphanums + "_")
+        | pp.QuotedString('"', escQuote='"', unquoteResults=False)
+        | pp.QuotedString("'", escQuote="'", unquoteResults=False)
+    )("create")
+
+    view = pp.Keyword("view", caseless=True).suppress() + (
+        pp.Word(pp.alphanums + "_")
+        | pp.QuotedString('"', escQuote='"', unquoteResults=False)
+    )("view")
+    matview = pp.Keyword("matview", caseless=True).suppress() + (
+        pp.Word(pp.alphanums + "_")
+        | pp.QuotedString('"', escQuote='"', unquoteResults=False)
+    )("matview")
+    unique = pp.Keyword("unique", caseless=True).suppress() + (
+        pp.QuotedString("'", escQuote="'") | pp.Word(pp.alphanums + "_,")
+    )("unique")
+    df_arrows = (pp.Word(pp.alphanums + "_") + pp.Keyword("<<").suppress())("df")
+
+    session = pp.Keyword("session", caseless=True).suppress() + pp.Word(
+        pp.alphanums + "_"
+    )("session")
+
+    csv = (
+        pp.Keyword("csv", caseless=True).suppress()
+        + (pp.QuotedString("'", escQuote="'") | pp.Word(pp.printables))
+    )("csv")
+
+    excel = (
+        pp.Keyword("excel", caseless=True).suppress()
+        + (pp.QuotedString("'", escQuote="'") | pp.Word(pp.printables))
+    )("excel")
+
+    commands = [arg_params, create, view, matview, unique, df_arrows, session, csv, excel]
+
+    for cmd_string in [
+        "df",
+        "sql",
+        "row",
+        "rows",
+        "col",
+        "cols",
+        "cell",
+        "record",
+        "records",
+        "headings",
+        "chunks",
+    ]:
+        commands.append(
+            pp.Word(pp.alphanums + "_")(cmd_string)
             + pp.Suppress("=")
-            + pp.QuotedString("'", escQuote="'")
-        )("arg_params")
-
-        create = pp.Keyword("create", caseless=True).suppress() + (
-            pp.Word(pp.alphanums + "_")
-            | pp.QuotedString('"', escQuote='"', unquoteResults=False)
-            | pp.QuotedString("'", escQuote="'", unquoteResults=False)
-        )("create")
-
-        view = pp.Keyword("view", caseless=True).suppress() + (
-            pp.Word(pp.alphanums + "_")
-            | pp.QuotedString('"', escQuote='"', unquoteResults=False)
-        )("view")
-        df_arrows = (pp.Word(pp.alphanums + "_") + pp.Keyword("<<").suppress())("df")
-
-        session = pp.Keyword("session", caseless=True).suppress() + pp.Word(
-            pp.alphanums + "_"
-        )("session")
-
-        csv = (
-            pp.Keyword("csv", caseless=True).suppress()
-            + (pp.QuotedString("'", escQuote="'") | pp.Word(pp.printables))
-        )("csv")
-
-        excel = (
-            pp.Keyword("excel", caseless=True).suppress()
-            + (pp.QuotedString("'", escQuote="'") | pp.Word(pp.printables))
-        )("excel")
-
-        commands = [arg_params, create, view, df_arrows, session, csv, excel]
-
-        for cmd_string in [
-            "df",
-            "sql",
-            "row",
-            "rows",
-            "col",
-            "cols",
-            "cell",
-            "record",
-            "records",
-            "headings",
-        ]:
-            commands.append(
-                pp.Word(pp.alphanums + "_")(cmd_string)
-                + pp.Suppress("=")
-                + pp.Keyword(cmd_string, caseless=True).suppress()
-            )
-
-        title = pp.Keyword("title", caseless=True).suppress() + (
-            pp.QuotedString("'", escQuote="'") | pp.Word(pp.printables)
-        )("title")
-        nojinja = (
-            pp.Keyword("nojinja", caseless=True) | pp.Keyword("noj", caseless=True)
-        )("nojinja")
-        show = pp.Keyword("show", caseless=True)("show")
-        timer = pp.Keyword("timer", caseless=True)("timer")
-        rest = pp.Word(pp.printables)("rest")
+            + pp.Keyword(cmd_string, caseless=True).suppress()
+        )
 
-        commands.extend([title, nojinja, show, timer, rest])
+    title = pp.Keyword("title", caseless=True).suppress() + (
+        pp.QuotedString("'", escQuote="'") | pp.Word(pp.printables)
+    )("title")
+    nojinja = (
+        pp.Keyword("nojinja", caseless=True) | pp.Keyword("noj", caseless=True)
+    )("nojinja")
+    show = pp.Keyword("show", caseless=True)("show")
+    timer = pp.Keyword("timer", caseless=True)("timer")
+    nocache = pp.Keyword("nocache", caseless=True)("nocache")
+    run_async = pp.Keyword("async", caseless=True)("async")
+    parallel = pp.Keyword("parallel", caseless=True)("parallel")
+    explain = pp.Keyword("explain", caseless=True)("explain")
+    analyze = pp.Keyword("analyze", caseless=True)("analyze")
+    force = pp.Keyword("force", caseless=True)("force")
+    rest = pp.Word(pp.printables)("rest")
+
+    commands.extend([title, nojinja, show, timer, nocache, run_async, parallel, explain, analyze, force, rest])
+
+    magic_line_parser = pp.ZeroOrMore(
+        pp.Group(pp.MatchFirst(commands)), stopOn=pp.LineEnd()
+    )
 
-        magic_line_parser = pp.ZeroOrMore(
-            pp.Group(pp.MatchFirst(commands)), stopOn=pp.LineEnd()
+    cell_parser = pp.OneOrMore(
+        pp.SkipTo(
+            (pp.LineStart() + pp.Group(pp.Keyword(f"%%{magic_name}") + magic_line_parser))
+            | pp.StringEnd(),
+            include=True,
         )
+    )
 
-        cell_parser = pp.OneOrMore(
-            pp.SkipTo(
-                (pp.LineStart() + pp.Group(pp.Keyword(f"%%{noteql_session.magic_name}") + magic_line_parser))
-                | pp.StringEnd(),
-                include=True,
-            )
-        )
+    return magic_line_parser, cell_parser
 
-        return magic_line_parser, cell_parser
 
-    def find_session(self):
-        ns = self.shell.user_ns
+@functools.lru_cache(maxsize=None)
+def magic_line_pattern(magic_name):
+    """Regex finding the `%%magic_name` lines the cell grammar splits on,
+    the keyword at the start of a line after any spaces or tabs."""
+    return re.compile(
+        r"^[ \t\r]*%%{}(?![{}])".format(re.escape(magic_name), re.escape(pp.Keyword.DEFAULT_KEYWORD_CHARS)),
+        re.M,
+    )
+
+
+def cell_parts(parsers, magic_name, line, cell):
+    """Split a `%%magic_name` cell into a list of (parsed magic line, sql),
+    one for each statement in it."""
+    magic_line_parser, cell_parser = parsers
+    parsed_line = magic_line_parser.parseString(line)
+    if magic_line_pattern(magic_name).search(cell):
+        parsed_cell = cell_parser.parseString(cell)
+    else:
+        # no more magic lines so the whole cell is one statement.
+        parsed_cell = [cell]
 
-        latest_session = None
+    parts = [(parsed_line, parsed_cell[0])]
+    for parsed_line, sql in zip(parsed_cell[1::2], parsed_cell[2::2]):
+        if not sql.strip():
+            print("Error in %%nql, empty sql statement")
+        parts.append((parsed_line[1:], sql))
+    return parts
 
-        for key, value in ns.items():
-            if isinstance(value, Session):
-                if not latest_session or value.last_set > latest_session.last_set:
-                    latest_session = value
+
+@magics_class
+class Noteql(Magics):
+    # workbooks written by the cell being run, saved when it finishes.
+    cell_workbooks = None
+
+    def get_parsers(self, noteql_session):
+        return make_parsers(noteql_session.magic_name)
+
+    def find_session(self):
+        latest_session = get_latest_session()
 
         if not latest_session:
             print("Need to define noteql seesion")
@@ -686,6 +1613,182 @@ class Noteql(Magics):
 
         return latest_session
 
+    def get_excel_writer(self, session, excel_file):
+        path = os.path.abspath(excel_file)
+        if path in session.workbooks:
+            return session.workbooks[path]
+        if self.cell_workbooks is None:
+            return None
+        if path not in self.cell_workbooks:
+            self.cell_workbooks[path] = ExcelWriter(excel_file)
+        return self.cell_workbooks[path]
+
+    def write_excel(self, session, excel_file, title, rows):
+        """Add a sheet of `rows`, the first being the headers, to `excel_file`.
+
+        The sheet goes into the session's or this cell's workbook for the
+        file if there is one, otherwise the file is written straight away.
+        """
+        rows = iter(rows)
+        headers = next(rows, None)
+        if headers is None:
+            return
+        rows = itertools.chain([headers], rows)
+        writer = self.get_excel_writer(session, excel_file)
+        if writer:
+            writer.add_sheet(title or "Sheet", rows)
+        else:
+            writer = ExcelWriter(excel_file)
+            writer.add_sheet(title or "Sheet", rows)
+            writer.save()
+
+    def execute_parallel(self, session, parts):
+        """Run the statements of a PARALLEL cell at the same time where they
+        do not depend on each other.
+
+        A statement waits for earlier ones that make a table, view, variable
+        or file that it uses or makes. Each runs on its own connection and
+        its output is shown in the order of the cell.
+        """
+        statements = []
+        for parsed_line, sql in parts:
+            outputs = set()
+            for item in parsed_line:
+                name = item.getName()
+                if name == "session":
+                    print("Error in %%nql, SESSION can not be used with PARALLEL")
+                    return []
+                if name in ("csv", "excel"):
+                    outputs.add(f"file:{os.path.abspath(item[0])}")
+                elif name in ("create", "view", "matview", "df", "sql", "row", "rows", "col", "cols",
+                              "cell", "record", "records", "headings", "chunks"):
+                    outputs.add(item[0])
+            statements.append((outputs, sql))
+
+        functions = [functools.partial(self.execute_part, parsed_line, sql) for parsed_line, sql in parts]
+        if session.database_per_thread():
+            return [function() for function in functions]
+
+        # running a query closes the preview, which the workers can not do.
+        session.close_preview()
+        dfs = []
+        with contextlib.redirect_stdout(ThreadStdout(sys.stdout)):
+            for df, output in run_graph(functions, dependencies(statements), session.async_workers):
+                output.replay()
+                dfs.append(df)
+        return dfs
+
+    def assign_dataframe(self, df, actions):
+        """Put `df` into the notebook namespace for the assignment commands in `actions`."""
+        ns = self.shell.user_ns
+
+        if actions.get("df"):
+            ns[actions["df"]] = df
+
+        if actions.get("col"):
+            ns[actions["col"]] = next(iter(df.to_dict("list").values()))
+
+        if actions.get("cols"):
+            ns[actions["cols"]] = list(df.to_dict("list").values())
+
+        if actions.get("row"):
+            ns[actions["row"]] = df.to_dict("split")["data"][0]
+
+        if actions.get("rows"):
+            ns[actions["rows"]] = df.to_dict("split")["data"]
+
+        if actions.get("cell"):
+            ns[actions["cell"]] = next(iter(df.to_dict("list").values()))[0]
+
+        if actions.get("record"):
+            ns[actions["record"]] = df.to_dict("records")[0]
+
+        if actions.get("records"):
+            ns[actions["records"]] = df.to_dict("records")
+
+        if actions.get("headings"):
+            ns[actions["headings"]] = list(df.columns)
+
+    def assign_rows(self, headers, rows, actions):
+        """Put `rows`, a list of tuples, into the notebook namespace for the
+        assignment commands in `actions`."""
+        ns = self.shell.user_ns
+
+        if actions.get("col"):
+            ns[actions["col"]] = [row[0] for row in rows]
+
+        if actions.get("cols"):
+            ns[actions["cols"]] = [list(column) for column in zip(*rows)] or [[] for header in headers]
+
+        if actions.get("row"):
+            ns[actions["row"]] = list(rows[0])
+
+        if actions.get("rows"):
+            ns[actions["rows"]] = [list(row) for row in rows]
+
+        if actions.get("cell"):
+            ns[actions["cell"]] = rows[0][0]
+
+        if actions.get("record"):
+            ns[actions["record"]] = dict(zip(headers, rows[0]))
+
+        if actions.get("records"):
+            ns[actions["records"]] = [dict(zip(headers, row)) for row in rows]
+
+        if actions.get("headings"):
+            ns[actions["headings"]] = headers
+
+    def submit_part(self, session, sql, params, actions, cache, force=False):
+        """Run a statement with the ASYNC command in the background.
+
+        CREATE and VIEW are made and the assignment commands are set in the
+        namespace when the query finishes.
+        """
+        unsupported = [command for command in ("show", "csv", "excel", "chunks", "matview") if command in actions]
+        if unsupported:
+            print(f"Error in %%nql, ASYNC can not be used with {', '.join(unsupported).upper()}")
+            return
+
+        assignments = ["df", "col", "cols", "row", "rows", "cell", "record", "records", "headings"]
+        create_name = actions.get("create")
+        view_name = actions.get("view")
+
+        def done(handle):
+            if handle.status == "done" and handle.result() is not None:
+                self.assign_dataframe(handle.result(), actions)
+
+        handle = session.submit(
+            sql,
+            params=params,
+            create=create_name,
+            view=view_name,
+            dataframe=any(actions.get(name) for name in assignments) or not (create_name or view_name),
+            cache=cache,
+            done=done,
+            force=force,
+        )
+        print(f"Running in the background as session.jobs[{len(session.jobs) - 1}]")
+        return handle
+
+    def explain_part(self, session, sql, params, actions, analyze):
+        """Show the plan of a statement with the EXPLAIN or ANALYZE command
+        instead of running it. The assignment commands get the plan nodes."""
+        unsupported = [
+            command for command in ("create", "view", "matview", "csv", "excel", "chunks") if command in actions
+        ]
+        if unsupported:
+            print(f"Error in %%nql, EXPLAIN can not be used with {', '.join(unsupported).upper()}")
+            return
+
+        plan = session.explain(sql, params=params, analyze=analyze)
+        print(plan.summary())
+        with phase("convert"):
+            self.assign_dataframe(plan.nodes, actions)
+        if not actions or "show" in actions:
+            with phase("display"):
+                display(plan.tree())
+        return plan.nodes
+
     def execute_part(self, parsed_line, sql):
         ns = self.shell.user_ns
 
@@ -697,6 +1800,11 @@ class Noteql(Magics):
         arg_params = {}
         jinja = True
         timer = False
+        cache = True
+        run_async = False
+        explain = False
+        analyze = False
+        force = False
         title = None
 
         for item in parsed_line:
@@ -730,6 +1838,8 @@ class Noteql(Magics):
                 "sql",
                 "create",
                 "view",
+                "matview",
+                "unique",
                 "row",
                 "rows",
                 "col",
@@ -738,6 +1848,7 @@ class Noteql(Magics):
                 "record",
                 "records",
                 "headings",
+                "chunks",
             ]:
                 if item.getName() == command:
                     if command in actions:
@@ -750,6 +1861,21 @@ class Noteql(Magics):
             if item.getName() == "timer":
                 timer = True
 
+            if item.getName() == "nocache":
+                cache = False
+
+            if item.getName() == "async":
+                run_async = True
+
+            if item.getName() == "explain":
+                explain = True
+
+            if item.getName() == "analyze":
+                analyze = True
+
+            if item.getName() == "force":
+                force = True
+
             if item.getName() == "show":
                 actions["show"] = True
 
@@ -760,43 +1886,46 @@ class Noteql(Magics):
                 title = item[0]
                 session.show_title(title)
 
-        params = None
-        if jinja:
-            namespace_copy = ns.copy()
-            namespace_copy.update(arg_params)
-            sql, params = session.jinjarender.prepare_query(sql, namespace_copy)
-        if not params:
+        with session.timings.query(sql, "magic"):
             params = None
+            if jinja:
+                with phase("render"):
+                    sql, params = session.render(sql, collections.ChainMap(arg_params, ns))
+
+            sql_variable = actions.get("sql")
+            if sql_variable:
+                if params:
+                    print("Error in %%nql, can have params if using SQL command")
+                    return
+                ns[sql_variable] = sql
 
-        sql_variable = actions.get("sql")
-        if sql_variable:
-            if params:
-                print("Error in %%nql, can have params if using SQL command")
-                return
-            ns[sql_variable] = sql
-
-        if not actions:
-            actions["show"] = True
-
-        df = None
-
-        df_name = actions.get("df")
-        csv_file = actions.get("csv")
-        excel_file = actions.get("excel")
-        col_name = actions.get("col")
-        cols_name = actions.get("cols")
-        row_name = actions.get("row")
-        rows_name = actions.get("rows")
-        cell_name = actions.get("cell")
-        record_name = actions.get("record")
-        records_name = actions.get("records")
-        headings_name = actions.get("headings")
-
-        show = "show" in actions
-
-        if any(
-            [
-                show,
+            if explain or analyze:
+                return self.explain_part(session, sql, params, actions, analyze)
+
+            if run_async:
+                return self.submit_part(session, sql, params, actions, cache, force)
+
+            if not actions:
+                actions["show"] = True
+
+            df = None
+
+            df_name = actions.get("df")
+            csv_file = actions.get("csv")
+            excel_file = actions.get("excel")
+            col_name = actions.get("col")
+            cols_name = actions.get("cols")
+            row_name = actions.get("row")
+            rows_name = actions.get("rows")
+            cell_name = actions.get("cell")
+            record_name = actions.get("record")
+            records_name = actions.get("records")
+            headings_name = actions.get("headings")
+            chunks_name = actions.get("chunks")
+
+            show = "show" in actions
+
+            targets = [
                 csv_file,
                 excel_file,
                 df_name,
@@ -809,82 +1938,93 @@ class Noteql(Magics):
                 records_name,
                 headings_name,
             ]
-        ):
-            df = session.get_dataframe(sql, params=params, timer=timer)
-            if df is None:
-                return
 
-            if df_name:
-                ns[df_name] = df
-
-            if col_name:
-                ns[col_name] = next(iter(df.to_dict("list").values()))
-
-            if cols_name:
-                ns[cols_name] = list(df.to_dict("list").values())
+            # These need a dataframe, the other targets are made from the rows.
+            frame_targets = [show, df_name]
+            row_targets = [col_name, cols_name, rows_name, records_name]
+            first_row_targets = [row_name, cell_name, record_name, headings_name]
+            # CSV or EXCEL alone are streamed, with other targets the rows are fetched once for all.
+            fetch_rows = any(row_targets + first_row_targets) or (csv_file and excel_file)
+
+            if fetch_rows and not any(frame_targets):
+                results = session.get_rows(
+                    sql,
+                    params=params,
+                    limit=None if any(row_targets + [csv_file, excel_file]) else 1,
+                    timer=timer,
+                    cache=cache,
+                )
+                if results is None:
+                    return
+                headers, rows = results
+
+                with phase("convert"):
+                    self.assign_rows(headers, rows, actions)
+
+                with phase("export"):
+                    if csv_file:
+                        write_csv(csv_file, headers, rows)
+                    if excel_file:
+                        self.write_excel(session, excel_file, title, [headers] + rows)
+            elif csv_file and not any(frame_targets):
+                session.export_csv(sql, csv_file, params=params, timer=timer)
+            elif excel_file and not any(frame_targets):
+                self.write_excel(session, excel_file, title, session.iter_rows(sql, params=params, timer=timer))
+
+            if any(frame_targets):
+                # cached sessions keep whole results so show uses them too. Previews
+                # are kept on the session so are only made on its own thread.
+                if (
+                    show
+                    and not any(targets)
+                    and session.preview_rows
+                    and not (cache and session.cache)
+                    and threading.current_thread() is session.thread
+                ):
+                    df = session.get_preview(sql, params=params, timer=timer)
+                else:
+                    df = session.get_dataframe(sql, params=params, timer=timer, cache=cache)
+                if df is None:
+                    return
 
-            if row_name:
-                ns[row_name] = df.to_dict("split")["data"][0]
+                with phase("convert"):
+                    self.assign_dataframe(df, actions)
 
-            if rows_name:
-                ns[rows_name] = df.to_dict("split")["data"]
+                with phase("export"):
+                    if csv_file:
+                        df.to_csv(csv_file, index=False)
 
-            if cell_name:
-                ns[cell_name] = next(iter(df.to_dict("list").values()))[0]
+                    if excel_file:
+                        self.write_excel(session, excel_file, title, dataframe_to_rows(df, header=True, index=False))
 
-            if record_name:
-                ns[record_name] = df.to_dict("records")[0]
+                if show:
+                    with phase("display"):
+                        if session.df_viewer:
+                            df = session.df_viewer(df, **session.df_viewer_kw)
+                        display(df)
 
-            if records_name:
-                ns[records_name] = df.to_dict("records")
+            if chunks_name:
+                ns[chunks_name] = session.iter_dataframes(sql, params=params)
 
-            if headings_name:
-                ns[headings_name] = list(df.columns)
+            create_name = actions.get("create")
 
-            if csv_file:
-                df.to_csv(csv_file, index=False)
+            if create_name:
+                session.create_table(create_name, sql, params, force=force)
 
-            if excel_file:
-                if title:
-                    ws_title = title
-                else:
-                    ws_title = "Sheet"
+            view_name = actions.get("view")
 
-                if os.path.exists(excel_file):
-                    wb = openpyxl.load_workbook(filename=excel_file)
-                    if ws_title in wb.sheetnames:
-                        raise Exception(
-                            f"%%nql error, sheet name {ws_title} already exists. Use a new sheet name by adding `TITLE 'My Sheet Name'`."
-                        )
-                    ws = wb.create_sheet(ws_title)
+            if view_name:
+                if create_name:
+                    session.create_view(view_name, f"select * from {create_name}", force=force)
                 else:
-                    wb = openpyxl.Workbook()
-                    ws = wb.active
-                    ws.title = ws_title
+                    session.create_view(view_name, sql, params, force=force)
 
-                for r in dataframe_to_rows(df, header=True, index=False):
-                    ws.append(r)
-                wb.save(excel_file)
+            matview_name = actions.get("matview")
 
-            if show:
-                if session.df_viewer:
-                    df = session.df_viewer(df, **session.df_viewer_kw)
-                display(df)
+            if matview_name:
+                session.create_materialized_view(matview_name, sql, params, unique=actions.get("unique"))
 
-        create_name = actions.get("create")
-
-        if create_name:
-            session.create_table(create_name, sql, params)
-
-        view_name = actions.get("view")
-
-        if view_name:
-            if create_name:
-                session.create_view(view_name, f"select * from {create_name}")
-            else:
-                session.create_view(view_name, sql, params)
-
-        return df
+            return df
 
     @line_cell_magic
     def nql(self, line, cell=None):
@@ -895,26 +2035,26 @@ class Noteql(Magics):
 
         if cell:
             dfs = []
-            magic_line_parser, cell_parser = self.get_parsers(session)
-
-            parsed_line = magic_line_parser.parseString(line)
-            parsed_cell = cell_parser.parseString(cell)
+            with session.timings.query(cell, "parse"), phase("parse"):
+                parts = cell_parts(self.get_parsers(session), session.magic_name, line, cell)
 
-            dfs.append(self.execute_part(parsed_line, parsed_cell[0]))
-
-            for parsed_line, sql in zip(parsed_cell[1::2], parsed_cell[2::2]):
-                if not sql.strip():
-                    print("Error in %%nql, empty sql statement")
-                dfs.append(self.execute_part(parsed_line[1:], sql))
+            self.cell_workbooks = {}
+            try:
+                if any(item.getName() == "parallel" for item in parts[0][0]):
+                    dfs = self.execute_parallel(session, parts)
+                else:
+                    for parsed_line, sql in parts:
+                        dfs.append(self.execute_part(parsed_line, sql))
+                # a cell that fails leaves the files as they were.
+                for writer in self.cell_workbooks.values():
+                    writer.save()
+            finally:
+                self.cell_workbooks = None
             if session.cell_magic_output:
                 return dfs
         else:
             ns = self.shell.user_ns
-            namespace_copy = ns.copy()
-            params = None
             line = line.replace("{", "{{").replace("}", "}}")
-            sql, params = session.jinjarender.prepare_query(line, namespace_copy)
-            if not params:
-                params = None
+            sql, params = session.render(line, ns)
 
             return session.get_dataframe(sql, params=params)
@@ -0,0 +1,137 @@
+import os
+import re
+import json
+import pickle
+import hashlib
+import tempfile
+import threading
+import collections
+
+
+def relation_name(relation):
+    """Bare lower case name of a possibly quoted and schema qualified relation."""
+    name = relation.strip().split(".")[-1]
+    return name.strip("\"'").lower()
+
+
+def references(sql, relation):
+    """Whether `relation` appears as a word anywhere in `sql`."""
+    pattern = r"(?<![\w]){}(?![\w])".format(re.escape(relation_name(relation)))
+    return re.search(pattern, sql.lower()) is not None
+
+
+# a name with a schema or database in front, not followed by a bracket as a function would be.
+QUALIFIED_NAME = re.compile(r'(?<![\w."])((?:[a-z_]\w*|"[^"]+")\.(?:[a-z_]\w*|"[^"]+"))(?![\w."(])', re.I)
+
+
+def qualified_names(sql):
+    """Schema qualified names such as `public.mytable` in `sql`. Columns
+    after a table alias match too, so these are only possible relations."""
+    return set(QUALIFIED_NAME.findall(sql))
+
+
+class ResultCache:
+    """LRU cache of query results held to a memory budget.
+
+    Entries are keyed on the rendered sql, params, schema, database and
+    fetch options. If `directory` is given results are also pickled there so
+    they survive a kernel restart. Invalidation is by relation name, any
+    cached query that mentions the name is dropped. It can be used from
+    many threads, files are written to a temporary name and moved into place.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        # sql for every entry on disk, used for invalidation without
+        # loading the results.
+        self.disk_index = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            if os.path.exists(self.index_path):
+                with open(self.index_path) as f:
+                    self.disk_index = json.load(f)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def write_file(self, path, write, mode="w"):
+        """Call `write` with a temporary file that is then moved to `path`."""
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, mode) as f:
+                write(f)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def save_index(self):
+        self.write_file(self.index_path, lambda f: json.dump(self.disk_index, f))
+
+    def key(self, *parts):
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][1].copy()
+            if key not in self.disk_index:
+                return None
+            try:
+                with open(self.entry_path(key), "rb") as f:
+                    df = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                self.remove(key)
+                return None
+            self.put(key, self.disk_index[key], df, write=False)
+            return df.copy()
+
+    def put(self, key, sql, df, write=True):
+        size = int(df.memory_usage(deep=True).sum())
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[2]
+            if size <= self.max_bytes:
+                self.entries[key] = (sql, df, size)
+                self.total_bytes += size
+                while self.total_bytes > self.max_bytes:
+                    _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                    self.total_bytes -= evicted_size
+
+            if self.directory and write:
+                self.write_file(self.entry_path(key), lambda f: pickle.dump(df, f), "wb")
+                self.disk_index[key] = sql
+                self.save_index()
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[2]
+            if key in self.disk_index:
+                del self.disk_index[key]
+                try:
+                    os.remove(self.entry_path(key))
+                except OSError:
+                    pass
+                self.save_index()
+
+    def invalidate(self, relation):
+        with self.lock:
+            keys = [key for key, (sql, _, _) in self.entries.items() if references(sql, relation)]
+            keys.extend(key for key, sql in self.disk_index.items() if references(sql, relation))
+            for key in set(keys):
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries) + list(self.disk_index):
+                self.remove(key)
@@ -0,0 +1,181 @@
+import io
+import re
+import json
+import threading
+import http.client
+import urllib.error
+import concurrent.futures
+from urllib.parse import urlsplit, urlencode
+
+import pandas
+
+from noteql.loaders import plain_query, sql_words
+
+
+def ordered(query):
+    """Whether `query` has an ORDER BY of its own, outside any brackets."""
+    text = sql_words(query)
+    while True:
+        text, count = re.subn(r"\([^()]*\)", " ", text)
+        if not count:
+            break
+    return re.search(r"\border\s+by\b", text, re.I) is not None
+
+
+class DatasetteClient:
+    """Client for the json api of a Datasette database.
+
+    `url` is the json url of the database, for example
+    `https://latest.datasette.io/fixtures.json`. Each thread keeps one
+    keep-alive connection to the server. Datasette truncates the results of
+    sql queries at its `max_returned_rows` setting and has no `_next` token
+    for them, so truncated queries are fetched again a page at a time with
+    limit and offset, `workers` pages at once. SQLite only keeps rows in the
+    same order between queries when asked to, so a truncated query without
+    an ORDER BY is paged again from the start ordered by all its columns.
+    Tables are paged by following `next_url`.
+    """
+
+    def __init__(self, url, workers=4, timeout=60):
+        self.url = url
+        self.workers = workers
+        self.timeout = timeout
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = parts.path
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, "connection", None) is None:
+            if self.scheme == "https":
+                self.local.connection = http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+            else:
+                self.local.connection = http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+        return self.local.connection
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def get_json(self, path, params=None):
+        """GET `path` on the server returning the decoded json.
+
+        The request is retried once on a new connection if the server has
+        closed the kept alive one.
+        """
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        for attempt in range(2):
+            connection = self.connection()
+            try:
+                connection.request("GET", path, headers={"Accept": "application/json"})
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.CannotSendRequest):
+                self.close()
+                if attempt:
+                    raise
+                continue
+            if response.status != 200:
+                raise urllib.error.HTTPError(
+                    f"{self.scheme}://{self.netloc}{path}",
+                    response.status,
+                    response.reason,
+                    response.headers,
+                    io.BytesIO(body),
+                )
+            return json.loads(body)
+
+    def query(self, sql, params=None):
+        url_params = {"sql": sql, "_shape": "arrays"}
+        if params:
+            url_params.update(params)
+        return self.get_json(self.path, url_params)
+
+    def iter_pages(self, sql, params=None):
+        """Yield the column names of `sql` then a list of rows for each page."""
+        result = self.query(sql, params)
+        yield result["columns"]
+
+        page_size = len(result["rows"])
+        query = plain_query(sql)
+        if not result.get("truncated") or not page_size or query is None:
+            yield result["rows"]
+            return
+
+        if ordered(query):
+            yield result["rows"]
+            offset = page_size
+            order = ""
+        else:
+            offset = 0
+            order = " order by " + ", ".join(str(num + 1) for num in range(len(result["columns"])))
+
+        def fetch_page(offset):
+            return self.query(
+                f"select * from (\n{query}\n){order} limit {page_size} offset {offset}", params
+            )["rows"]
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            while True:
+                offsets = [offset + page_size * num for num in range(self.workers)]
+                for rows in executor.map(fetch_page, offsets):
+                    if rows:
+                        yield rows
+                    if len(rows) < page_size:
+                        return
+                offset = offsets[-1] + page_size
+
+    def iter_table_pages(self, table):
+        """Yield the column names of `table` then a list of rows for each
+        page, following `next_url` until the end of the table."""
+        path = self.path[: -len(".json")] if self.path.endswith(".json") else self.path
+        result = self.get_json(f"{path}/{table}.json", {"_shape": "arrays", "_size": "max"})
+        yield result["columns"]
+        yield result["rows"]
+        while result.get("next_url"):
+            next_url = urlsplit(result["next_url"])
+            result = self.get_json(f"{next_url.path}?{next_url.query}")
+            yield result["rows"]
+
+    def iter_dataframes(self, pages, chunksize=None):
+        """Dataframes of up to `chunksize` rows from the output of `iter_pages`."""
+        columns = next(pages)
+        buffer = []
+        for rows in pages:
+            buffer.extend(rows)
+            while chunksize and len(buffer) >= chunksize:
+                yield pandas.DataFrame(buffer[:chunksize], columns=columns)
+                del buffer[:chunksize]
+        if buffer or not chunksize:
+            yield pandas.DataFrame(buffer, columns=columns)
+
+    def get_dataframe(self, sql, params=None):
+        return next(self.iter_dataframes(self.iter_pages(sql, params)))
+
+    def get_table(self, table):
+        return next(self.iter_dataframes(self.iter_table_pages(table)))
+
+    def tables(self):
+        database = self.get_json(self.path)
+        return pandas.DataFrame(
+            [
+                {
+                    "name": table["name"],
+                    "count": table.get("count"),
+                    "fields": ", ".join(table.get("columns", [])),
+                }
+                for table in database["tables"]
+                if not table.get("hidden")
+            ],
+            columns=["name", "count", "fields"],
+        )
+
+    def fields(self, table):
+        return self.get_dataframe(
+            "select name, upper(case when type = '' then 'TEXT' else type end) type FROM pragma_table_info(:table)",
+            {"table": table},
+        )
@@ -0,0 +1,45 @@
+import os
+
+import openpyxl
+
+
+class ExcelWriter:
+    """Workbook that sheets are added to and is saved once.
+
+    New files are write only workbooks that rows are streamed into. An
+    existing file is loaded as it is, so its sheets keep their styles,
+    formats and formulas, and the new sheets are added to it. It can be
+    used as a context manager which saves on exit, `on_save` is called with
+    the writer after saving.
+    """
+
+    def __init__(self, file_name, on_save=None):
+        self.file_name = file_name
+        self.on_save = on_save
+        if os.path.exists(file_name):
+            self.workbook = openpyxl.load_workbook(filename=file_name)
+        else:
+            self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet_names = list(self.workbook.sheetnames)
+
+    def add_sheet(self, title, rows):
+        """Add a sheet named `title` with the rows of an iterable of tuples."""
+        if title in self.sheet_names:
+            raise Exception(
+                f"%%nql error, sheet name {title} already exists. Use a new sheet name by adding `TITLE 'My Sheet Name'`."
+            )
+        self.sheet_names.append(title)
+        sheet = self.workbook.create_sheet(title)
+        for row in rows:
+            sheet.append(row)
+
+    def save(self):
+        self.workbook.save(self.file_name)
+        if self.on_save:
+            self.on_save(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
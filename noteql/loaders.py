@@ -0,0 +1,776 @@
+import io
+import re
+import csv
+import gzip
+import hashlib
+import datetime
+import time
+import itertools
+import contextlib
+
+import pandas
+
+from noteql.timing import phase
+from noteql.plans import Plan, decode, postgres_nodes, duckdb_nodes, sqlite_nodes
+
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+
+def batched(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def fetched(cursor, batch_size):
+    """Rows of `cursor`, fetched `batch_size` at a time."""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def quote_columns(columns):
+    return ", ".join('"{}"'.format(column) for column in columns)
+
+
+def open_output(file_name):
+    """Open a text file for writing, gzipped if the name ends in `.gz`."""
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, "wt", newline="")
+    return open(file_name, "w", newline="")
+
+
+def write_csv(file_name, headers, rows):
+    """Write `headers` then the `rows`, any iterable of tuples, to the csv
+    file `file_name`."""
+    with open_output(file_name) as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(headers)
+        writer.writerows(rows)
+
+
+def copy_csv_field(value):
+    """Text `value` quoted as COPY quotes csv, so empty strings and nulls
+    differ."""
+    if value is None:
+        return ""
+    if value in ("", "\\.") or re.search(r'[",\r\n]', value):
+        return '"{}"'.format(value.replace('"', '""'))
+    return value
+
+
+def write_copy_csv(file_name, headers, rows):
+    """Write `headers` then the `rows` of text values to the csv file
+    `file_name` as COPY would."""
+    with open_output(file_name) as f:
+        for row in itertools.chain([headers], rows):
+            f.write(",".join(map(copy_csv_field, row)) + "\n")
+
+
+def relation_sql(name):
+    """`name` for use in sql, quoted if it is a name from the catalog and as
+    it is if it is a schema qualified name taken from sql."""
+    if "." in name:
+        return name
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def suffixed(name, suffix):
+    """`name`, which may be quoted, with `suffix` added to the end of it."""
+    if name.endswith('"'):
+        return name[:-1] + suffix + '"'
+    return name + suffix
+
+
+def sql_words(sql):
+    """`sql` with string literals emptied, quoted names replaced by a plain
+    name and comments removed, so only its own keywords are left."""
+    return re.sub(
+        r"'(?:[^']|'')*'|(\"(?:[^\"]|\"\")*\")|--[^\n]*|/\*.*?\*/",
+        lambda match: "name" if match.group(1) else "''" if match.group(0).startswith("'") else " ",
+        sql,
+        flags=re.S,
+    )
+
+
+def plain_query(sql):
+    """`sql` without a trailing semicolon if it is a query that can be
+    wrapped in COPY or run in a server side cursor, otherwise None.
+
+    SELECT ... INTO makes a table and a WITH can hold an INSERT, UPDATE or
+    DELETE, postgres allows neither in COPY or a cursor.
+    """
+    query = sql.strip().rstrip(";")
+    if not re.match(r"(\s*--[^\n]*\n)*\s*(select|with|values|table)\b", query, re.I):
+        return None
+    words = sql_words(query)
+    if re.search(r"\binto\b|\bupdate\s+\S+\s+set\b|\bdelete\s+from\b|\binsert\s+into\b|\bmerge\s+into\b", words, re.I):
+        return None
+    return query
+
+
+def arrow_columns(rows, headers):
+    arrays = []
+    for column in zip(*rows):
+        try:
+            arrays.append(pyarrow.array(column))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            # sqlite columns can mix types.
+            arrays.append(pyarrow.array([None if value is None else str(value) for value in column]))
+    return pyarrow.Table.from_arrays(arrays, names=headers)
+
+
+class Loader:
+    """Database specific bulk loading and fetching for a `Session`.
+
+    One loader is made per connection. Subclasses override the column types,
+    the insert path and the arrow fetch for each database, this base class
+    is plain sql with executemany.
+    """
+
+    id_column = "id serial"
+    json_type = "jsonb"
+    xml_type = "xml"
+    placeholder = "%s"
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @classmethod
+    def setup_statements(cls, schema=None, settings=None):
+        """Statements run once on each new connection to set the schema
+        search path and other session settings such as work_mem."""
+        statements = []
+        if schema:
+            statements.append("set search_path = {}".format(schema))
+        for name, value in (settings or {}).items():
+            statements.append("set {} = '{}'".format(name, str(value).replace("'", "''")))
+        return statements
+
+    @classmethod
+    def cancel(cls, dbapi_connection):
+        """Cancel the statement running on `dbapi_connection` from another thread."""
+        dbapi_connection.cancel()
+
+    def table_exists(self, table, schema=None):
+        schema_sql = self.placeholder if schema else "current_schema()"
+        params = [table, schema] if schema else [table]
+        result = self.connection.execute(
+            "select exists(select * from information_schema.tables where table_name={} and table_schema={})".format(
+                self.placeholder, schema_sql
+            ),
+            *params,
+        )
+        return bool(result.fetchall()[0][0])
+
+    def drop_table(self, full_name):
+        self.connection.execute("drop table if exists {}".format(full_name))
+
+    # records the fingerprint of each table made by an incremental CREATE.
+    builds_table = "noteql_builds"
+
+    def relations(self):
+        """Dict of the tables and views in the current schema to a marker that
+        changes when the relation is made again, None if there is no marker."""
+        result = self.connection.execute(
+            "select table_name from information_schema.tables where table_schema = current_schema()"
+        )
+        return {name: None for name, in result}
+
+    def relation_kind(self, name):
+        """What `name` is, "table", "view" or None if it does not exist."""
+        parts = [part.strip('"') for part in name.split(".")]
+        if len(parts) > 1:
+            # the schema, or on duckdb an attached database.
+            schema_sql = "{p} in (table_schema, table_catalog)".format(p=self.placeholder)
+        else:
+            schema_sql = "table_schema = current_schema()"
+        result = self.connection.execute(
+            "select table_type from information_schema.tables where table_name = {} and {}".format(
+                self.placeholder, schema_sql
+            ),
+            *reversed(parts),
+        ).fetchone()
+        if result is None:
+            return None
+        return "view" if result[0] == "VIEW" else "table"
+
+    def drop_relation(self, name):
+        """Drop `name` with the DROP statement for whatever it is."""
+        kind = self.relation_kind(name)
+        if kind:
+            self.connection.execute("drop {} {}".format(kind, name))
+
+    def relation_marker(self, name):
+        """Marker of the one relation `name`, which may be schema qualified,
+        as in `relations()`."""
+        return None
+
+    def count_rows(self, name):
+        return self.connection.execute("select count(*) from {}".format(relation_sql(name))).scalar()
+
+    def content_version(self, name):
+        """Something that changes when the rows of `name` change. Here it is
+        the row count, so changes that keep the count are not noticed."""
+        return self.count_rows(name)
+
+    def get_build(self, relation):
+        """Fingerprint of the last incremental build of `relation`, or None."""
+        result = self.connection.execute(
+            "select fingerprint from {} where relation = {}".format(self.builds_table, self.placeholder),
+            relation,
+        )
+        row = result.fetchone()
+        return row[0] if row else None
+
+    def set_build(self, relation, fingerprint):
+        self.connection.execute(
+            "create table if not exists {}(relation text primary key, fingerprint text, built_at text)".format(
+                self.builds_table
+            )
+        )
+        self.connection.execute(
+            "delete from {} where relation = {}".format(self.builds_table, self.placeholder), relation
+        )
+        self.connection.execute(
+            "insert into {} values ({p}, {p}, {p})".format(self.builds_table, p=self.placeholder),
+            relation,
+            fingerprint,
+            datetime.datetime.now().isoformat(timespec="seconds"),
+        )
+
+    def create_table(self, full_name, columns, with_id=False):
+        """Create table if it does not exist. `columns` is a list of (name, type)."""
+        definitions = ['"{}" {}'.format(name, type) for name, type in columns]
+        if with_id:
+            definitions.insert(0, self.id_column)
+        self.connection.execute(
+            "create table if not exists {}({})".format(full_name, ", ".join(definitions))
+        )
+
+    def insert_batch(self, full_name, columns, batch):
+        self.connection.execute(
+            "insert into {}({}) values ({})".format(
+                full_name,
+                quote_columns(columns),
+                ", ".join([self.placeholder] * len(columns)),
+            ),
+            batch,
+        )
+
+    def insert_rows(self, full_name, columns, rows, batch_size=10000):
+        """Insert an iterable of row tuples in batches of `batch_size`.
+
+        Only one batch is held in memory at a time. Returns the number of
+        rows inserted.
+        """
+        total = 0
+        batches = batched(rows, batch_size)
+        with self.bulk():
+            while True:
+                with phase("read"):
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                with phase("insert"):
+                    self.insert_batch(full_name, columns, batch)
+                total += len(batch)
+        return total
+
+    def load_json_array(self, full_name, column, file_name):
+        """Load a file containing a top level json array natively.
+
+        Returns the number of rows loaded or None if the database has no
+        native way of doing this.
+        """
+        return None
+
+    def bulk(self):
+        return contextlib.nullcontext()
+
+    def execute(self, sql, params=None):
+        if params:
+            return self.connection.execute(sql, params)
+        return self.connection.execute(sql)
+
+    def time_query(self, sql, params=None):
+        """Seconds taken to run `sql` and fetch all its rows."""
+        start = time.perf_counter()
+        result = self.execute(sql, params)
+        if result.returns_rows:
+            result.fetchall()
+        return time.perf_counter() - start
+
+    def create_materialized_view(self, name, sql, params=None, unique=None):
+        """Make `name` a table of the results of `sql` for databases without
+        materialized views.
+
+        The table is built under a new name and swapped in, so until the
+        transaction commits readers see the old rows. `unique` is the
+        columns of a unique index, made after the swap as DuckDB can not
+        rename a table with an index.
+        """
+        new_name = suffixed(name, "__noteql_new")
+        self.connection.execute("drop table if exists {}".format(new_name))
+        self.execute("create table {} as\n{}".format(new_name, sql), params)
+        self.drop_relation(name)
+        self.connection.execute(
+            "alter table {} rename to {}".format(new_name, name.split(".")[-1])
+        )
+        if unique:
+            self.connection.execute(
+                "create unique index {} on {} ({})".format(
+                    suffixed(name.split(".")[-1], "_unique"), name, unique
+                )
+            )
+        return "Swapped"
+
+    def explain(self, sql, params=None, analyze=False):
+        """`Plan` of `sql` from the database's EXPLAIN.
+
+        This base version keeps each line of the text plan as a node. With
+        `analyze` the query is also run to time it.
+        """
+        nodes = [
+            {"id": num, "depth": 0, "node": " ".join(str(value) for value in row)}
+            for num, row in enumerate(self.execute("explain " + sql, params))
+        ]
+        seconds = self.time_query(sql, params) if analyze else None
+        return Plan(sql, nodes, time=seconds, analyze=analyze)
+
+    def export_csv(self, sql, file_name, params=None, batch_size=10000):
+        """Write the results of `sql` with a header row to the csv file `file_name`.
+
+        Rows are written in batches of `batch_size` as they are fetched, so
+        the whole result is never in memory.
+        """
+        cursor = self.connection.connection.cursor()
+        try:
+            if params:
+                cursor.execute(sql, params)
+            else:
+                cursor.execute(sql)
+            if cursor.description is None:
+                return
+            write_csv(file_name, [column[0] for column in cursor.description], fetched(cursor, batch_size))
+        finally:
+            cursor.close()
+
+    def fetch_arrow(self, sql, params=None, batch_size=10000):
+        """Run `sql` returning a pyarrow table, or None if it returns no rows.
+
+        This base version builds each batch of rows straight into arrow
+        columns without making a python object per cell for pandas.
+        """
+        # the dbapi cursor gives plain tuples which are quicker to transpose
+        # than sqlalchemy rows.
+        cursor = self.connection.connection.cursor()
+        try:
+            with phase("execute"):
+                if params:
+                    cursor.execute(sql, params)
+                else:
+                    cursor.execute(sql)
+            if cursor.description is None:
+                return None
+            headers = [column[0] for column in cursor.description]
+            tables = []
+            while True:
+                with phase("fetch"):
+                    rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                with phase("dataframe"):
+                    tables.append(arrow_columns(rows, headers))
+        finally:
+            cursor.close()
+        if not tables:
+            return pyarrow.Table.from_arrays(
+                [pyarrow.array([], pyarrow.null()) for header in headers], names=headers
+            )
+        return pyarrow.concat_tables(tables, promote_options="permissive")
+
+
+class PostgresLoader(Loader):
+    def insert_batch(self, full_name, columns, batch):
+        if self.connection.dialect.driver != "psycopg2":
+            return super().insert_batch(full_name, columns, batch)
+
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+
+        cursor = self.connection.connection.cursor()
+        try:
+            cursor.copy_expert(
+                "copy {}({}) from stdin with (format csv)".format(
+                    full_name, quote_columns(columns)
+                ),
+                buffer,
+            )
+        finally:
+            cursor.close()
+
+    def export_csv(self, sql, file_name, params=None, batch_size=10000):
+        """Stream the results with COPY TO STDOUT straight into the file.
+
+        Statements that can not be copied, such as INSERT ... RETURNING, are
+        fetched with every value as the text postgres gives for it, which is
+        what COPY writes, and written with COPY's quoting.
+        """
+        if self.connection.dialect.driver != "psycopg2":
+            print(f"{file_name} written from the fetched rows, not with COPY, so values are as python shows them")
+            return super().export_csv(sql, file_name, params, batch_size)
+
+        query = plain_query(sql)
+        cursor = self.connection.connection.cursor()
+        try:
+            if query is None:
+                import psycopg2.extensions
+
+                cursor.execute("select oid from pg_type")
+                oids = tuple(row[0] for row in cursor.fetchall())
+                psycopg2.extensions.register_type(
+                    psycopg2.extensions.new_type(oids, "NOTEQL_TEXT", lambda value, cursor: value), cursor
+                )
+                if params:
+                    cursor.execute(sql, params)
+                else:
+                    cursor.execute(sql)
+                if cursor.description is None:
+                    return
+                write_copy_csv(file_name, [column.name for column in cursor.description], fetched(cursor, batch_size))
+                return
+
+            query = cursor.mogrify(query, params or {}).decode()
+            with open_output(file_name) as f:
+                cursor.copy_expert(
+                    "copy (\n{}\n) to stdout with (format csv, header)".format(query), f
+                )
+        finally:
+            cursor.close()
+
+    def create_materialized_view(self, name, sql, params=None, unique=None):
+        """Create a materialized view, or refresh it if it was made from the
+        same sql, params and unique index before.
+
+        The refresh is concurrent, so readers are not locked out, when there
+        is a unique index. The sql it was made from is kept as a hash in the
+        view's comment, if it has changed the view is made again.
+        """
+        marker = "noteql " + hashlib.sha256(repr((sql, params, unique)).encode()).hexdigest()[:16]
+        existing = self.connection.execute(
+            "select relkind, obj_description(oid, 'pg_class') from pg_class where oid = to_regclass(%s)",
+            name,
+        ).fetchone()
+        if existing and existing[0] == "m" and existing[1] == marker:
+            self.connection.execute(
+                "refresh materialized view {}{}".format("concurrently " if unique else "", name)
+            )
+            return "Refreshed"
+
+        self.drop_relation(name)
+        self.execute("create materialized view {} as\n{}".format(name, sql), params)
+        if unique:
+            self.connection.execute(
+                "create unique index on {} ({})".format(name, unique)
+            )
+        self.connection.execute("comment on materialized view {} is '{}'".format(name, marker))
+        return "Created"
+
+    def relation_kind(self, name):
+        kind = self.connection.execute("select relkind from pg_class where oid = to_regclass(%s)", name).scalar()
+        return {"r": "table", "p": "table", "v": "view", "m": "materialized view", "f": "foreign table"}.get(kind)
+
+    def relation_marker(self, name):
+        return self.connection.execute("select to_regclass(%s)::oid::text", name).scalar()
+
+    def relations(self):
+        # the oid is new each time a relation is made.
+        result = self.connection.execute(
+            "select relname, oid::text from pg_class where relkind in ('r', 'p', 'v', 'm', 'f') "
+            "and relnamespace = current_schema()::regnamespace"
+        )
+        return dict(result.fetchall())
+
+    def set_build(self, relation, fingerprint):
+        # builds made at the same time could all try to create the table.
+        self.connection.execute("select pg_advisory_xact_lock(hashtext(%s))", self.builds_table)
+        super().set_build(relation, fingerprint)
+
+    def explain(self, sql, params=None, analyze=False):
+        options = "format json, analyze" if analyze else "format json"
+        plan = decode(self.execute(f"explain ({options})\n{sql}", params).scalar())[0]
+        execution_time = plan.get("Execution Time")
+        return Plan(
+            sql,
+            postgres_nodes(plan["Plan"]),
+            cost=plan["Plan"].get("Total Cost"),
+            time=None if execution_time is None else execution_time / 1000,
+            analyze=analyze,
+        )
+
+    # postgres type oids that arrow can read from csv, others are kept as text.
+    arrow_types = {
+        16: "bool_",
+        20: "int64",
+        21: "int16",
+        23: "int32",
+        700: "float32",
+        701: "float64",
+        1700: "float64",
+        1082: "date32",
+    }
+
+    def fetch_arrow(self, sql, params=None, batch_size=10000):
+        """Fetch with COPY TO STDOUT and parse the csv with arrow.
+
+        Only plain queries are copied, anything else uses the base version.
+        numeric is read as float64 and types arrow can not read from csv,
+        including json, come back as strings.
+        """
+        query = plain_query(sql)
+        if self.connection.dialect.driver != "psycopg2" or query is None:
+            return super().fetch_arrow(sql, params, batch_size)
+
+        cursor = self.connection.connection.cursor()
+        try:
+            # always interpolated, so %% is treated as it is by sqlalchemy.
+            query = cursor.mogrify(query, params or {}).decode()
+            cursor.execute("set local timezone = 'UTC'; set local datestyle = 'ISO, YMD'")
+            cursor.execute("select * from (\n{}\n) noteql_query limit 0".format(query))
+            headers = [column.name for column in cursor.description]
+            column_types = {}
+            for column in cursor.description:
+                if column.type_code in self.arrow_types:
+                    column_types[column.name] = getattr(pyarrow, self.arrow_types[column.type_code])()
+                elif column.type_code == 1114:
+                    column_types[column.name] = pyarrow.timestamp("us")
+                elif column.type_code == 1184:
+                    column_types[column.name] = pyarrow.timestamp("us", tz="UTC")
+                else:
+                    column_types[column.name] = pyarrow.string()
+
+            buffer = io.BytesIO()
+            with phase("fetch"):
+                cursor.copy_expert(
+                    "copy (\n{}\n) to stdout with (format csv)".format(query), buffer
+                )
+        finally:
+            cursor.close()
+
+        buffer.seek(0)
+        with phase("dataframe"):
+            return pyarrow.csv.read_csv(
+                buffer,
+                read_options=pyarrow.csv.ReadOptions(column_names=headers),
+                convert_options=pyarrow.csv.ConvertOptions(
+                    column_types=column_types,
+                    true_values=["t"],
+                    false_values=["f"],
+                    null_values=[""],
+                    strings_can_be_null=True,
+                    quoted_strings_can_be_null=False,
+                ),
+            )
+
+
+class SqliteLoader(Loader):
+    id_column = "id integer primary key"
+    json_type = "json"
+    xml_type = "text"
+    placeholder = "?"
+
+    # The whole load is one transaction so there is only one sync on commit,
+    # these keep the pages being written in memory until then.
+    bulk_pragmas = {
+        "temp_store": "MEMORY",
+        "cache_size": "-65536",
+    }
+
+    @classmethod
+    def setup_statements(cls, schema=None, settings=None):
+        # schemas in sqlite are attached databases and are always explicit,
+        # settings are pragmas.
+        return [
+            "pragma {} = {}".format(name, value) for name, value in (settings or {}).items()
+        ]
+
+    @classmethod
+    def cancel(cls, dbapi_connection):
+        dbapi_connection.interrupt()
+
+    def table_exists(self, table, schema=None):
+        master = '"{}".sqlite_master'.format(schema) if schema else "sqlite_master"
+        result = self.connection.execute(
+            "select exists(select * from {} where type = 'table' and name = ?)".format(master),
+            table,
+        )
+        return bool(result.fetchall()[0][0])
+
+    @contextlib.contextmanager
+    def bulk(self):
+        previous = {
+            pragma: self.connection.execute("pragma {}".format(pragma)).scalar()
+            for pragma in self.bulk_pragmas
+        }
+        for pragma, value in self.bulk_pragmas.items():
+            self.connection.execute("pragma {} = {}".format(pragma, value))
+        try:
+            yield
+        finally:
+            for pragma, value in previous.items():
+                self.connection.execute("pragma {} = {}".format(pragma, value))
+
+    def relation_kind(self, name):
+        parts = [part.strip('"') for part in name.split(".")]
+        master = "sqlite_master"
+        if len(parts) > 1:
+            databases = [row[1] for row in self.connection.execute("pragma database_list")]
+            if parts[0] not in databases:
+                return None
+            master = '"{}".sqlite_master'.format(parts[0])
+        return self.connection.execute(
+            "select type from {} where name = ? and type in ('table', 'view')".format(master), parts[-1]
+        ).scalar()
+
+    def relations(self):
+        result = self.connection.execute(
+            "select name from sqlite_master where type in ('table', 'view') and name not like 'sqlite_%'"
+        )
+        return {name: None for name, in result}
+
+    def content_version(self, name, batch_size=10000):
+        # sqlite keeps nothing that changes when a table does, so the rows are hashed.
+        checksum = hashlib.sha256()
+        result = self.connection.execute("select * from {}".format(relation_sql(name)))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            checksum.update(repr([tuple(row) for row in rows]).encode())
+        return checksum.hexdigest()
+
+    def explain(self, sql, params=None, analyze=False):
+        """sqlite plans have no costs, with `analyze` the query is run to time it."""
+        nodes = sqlite_nodes(self.execute("explain query plan " + sql, params).fetchall())
+        seconds = self.time_query(sql, params) if analyze else None
+        return Plan(sql, nodes, time=seconds, analyze=analyze)
+
+
+class DuckdbLoader(Loader):
+    json_type = "json"
+    xml_type = "varchar"
+    placeholder = "?"
+
+    @classmethod
+    def setup_statements(cls, schema=None, settings=None):
+        statements = super().setup_statements(None, settings)
+        if schema:
+            statements.insert(0, "set search_path = '{}'".format(schema))
+        return statements
+
+    @classmethod
+    def cancel(cls, dbapi_connection):
+        dbapi_connection.interrupt()
+
+    def sequence_name(self, full_name):
+        return full_name[:-1] + '_id_seq"'
+
+    def drop_table(self, full_name):
+        super().drop_table(full_name)
+        self.connection.execute(
+            "drop sequence if exists {}".format(self.sequence_name(full_name))
+        )
+
+    def create_table(self, full_name, columns, with_id=False):
+        if with_id:
+            sequence = self.sequence_name(full_name)
+            self.connection.execute("create sequence if not exists {}".format(sequence))
+            self.id_column = "id bigint default nextval('{}')".format(
+                sequence.replace("'", "''")
+            )
+        super().create_table(full_name, columns, with_id)
+
+    def insert_batch(self, full_name, columns, batch):
+        # Registering a dataframe lets duckdb append the whole batch in one
+        # vectorised insert rather than binding parameters row by row.
+        duckdb_connection = self.connection.connection.connection
+        duckdb_connection.register(
+            "noteql_batch", pandas.DataFrame(batch, columns=columns)
+        )
+        try:
+            self.connection.execute(
+                "insert into {}({}) select * from noteql_batch".format(
+                    full_name, quote_columns(columns)
+                )
+            )
+        finally:
+            duckdb_connection.unregister("noteql_batch")
+
+    def load_json_array(self, full_name, column, file_name):
+        count_sql = "select count(*) from {}".format(full_name)
+        before = self.connection.execute(count_sql).scalar()
+        self.connection.execute(
+            "insert into {}(\"{}\") select json from read_json_objects('{}', format='array')".format(
+                full_name, column, file_name.replace("'", "''")
+            )
+        )
+        return self.connection.execute(count_sql).scalar() - before
+
+    def export_csv(self, sql, file_name, params=None, batch_size=10000):
+        query = plain_query(sql)
+        if query is None:
+            print(f"{file_name} written from the fetched rows, not with COPY, so values are as python shows them")
+            return super().export_csv(sql, file_name, params, batch_size)
+        options = "header"
+        if file_name.endswith(".gz"):
+            options += ", compression 'gzip'"
+        self.execute(
+            "copy (\n{}\n) to '{}' ({})".format(query, file_name.replace("'", "''"), options), params
+        )
+
+    def relations(self):
+        # oids are new each time a relation is made.
+        result = self.connection.execute(
+            "select table_name, table_oid from duckdb_tables() "
+            "where schema_name = current_schema() and database_name = current_database() "
+            "union all select view_name, view_oid from duckdb_views() "
+            "where schema_name = current_schema() and database_name = current_database() and not internal"
+        )
+        return dict(result.fetchall())
+
+    def explain(self, sql, params=None, analyze=False):
+        options = "analyze, format json" if analyze else "format json"
+        plan = decode(self.execute(f"explain ({options})\n{sql}", params).fetchall()[0][1])
+        return Plan(
+            sql,
+            duckdb_nodes(plan),
+            time=plan.get("latency") if analyze else None,
+            analyze=analyze,
+        )
+
+    def fetch_arrow(self, sql, params=None, batch_size=10000):
+        duckdb_connection = self.connection.connection.connection
+        with phase("execute"):
+            result = duckdb_connection.execute(sql, params or [])
+        if result.description is None:
+            return None
+        with phase("fetch"):
+            return result.fetch_arrow_table()
+
+
+loaders = {
+    "postgresql": PostgresLoader,
+    "sqlite": SqliteLoader,
+    "duckdb": DuckdbLoader,
+}
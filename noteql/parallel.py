@@ -0,0 +1,143 @@
+import sys
+import threading
+import concurrent.futures
+
+import IPython.display
+
+from noteql.cache import references
+
+# output of the statement being run on this thread, if it is being captured.
+capture = threading.local()
+
+
+def display(obj):
+    """Display `obj`, or keep it to display later if output is being captured."""
+    output = getattr(capture, "output", None)
+    if output is None:
+        IPython.display.display(obj)
+    else:
+        output.items.append(("display", obj))
+
+
+class CapturedOutput:
+    """Printed text and displayed objects of one statement, in order."""
+
+    def __init__(self):
+        self.items = []
+
+    def write(self, text):
+        self.items.append(("text", text))
+
+    def replay(self):
+        for kind, item in self.items:
+            if kind == "text":
+                sys.stdout.write(item)
+            else:
+                IPython.display.display(item)
+
+
+class ThreadStdout:
+    """Stand in for sys.stdout that sends writes from threads capturing
+    their output to that thread's `CapturedOutput`."""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def write(self, text):
+        output = getattr(capture, "output", None)
+        if output is None:
+            return self.stdout.write(text)
+        output.write(text)
+        return len(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+def dependencies(statements):
+    """Indexes of the earlier statements each statement has to wait for.
+
+    `statements` is a list of (outputs, sql) where outputs are the names a
+    statement writes, tables, views, variables or files. A statement waits
+    for an earlier one if it reads or writes something the earlier one
+    writes, or writes something the earlier one reads. Reads are found by
+    looking for the written names as words in the sql.
+    """
+    all_outputs = set().union(*(outputs for outputs, sql in statements))
+    reads = [
+        {name for name in all_outputs if references(sql, name)} for outputs, sql in statements
+    ]
+    graph = []
+    for index, (outputs, sql) in enumerate(statements):
+        graph.append({
+            earlier
+            for earlier, (earlier_outputs, earlier_sql) in enumerate(statements[:index])
+            if earlier_outputs & (reads[index] | outputs) or outputs & reads[earlier]
+        })
+    return graph
+
+
+def run_graph(functions, graph, workers):
+    """Run each function once the functions it depends on in `graph` have
+    finished, up to `workers` at once.
+
+    Yields (result, output) in the order of `functions`, each as soon as it
+    and all before it are done, where output is its `CapturedOutput`. If one
+    raises no more are started, the ones that finished are yielded and the
+    first error is raised. With `workers` of 0 the functions are run one at
+    a time, in order, on this thread.
+    """
+    outputs = [CapturedOutput() for function in functions]
+
+    def run(index):
+        capture.output = outputs[index]
+        try:
+            return functions[index]()
+        finally:
+            capture.output = None
+
+    if not workers:
+        for index in range(len(functions)):
+            try:
+                result = run(index)
+            except Exception:
+                yield None, outputs[index]
+                raise
+            yield result, outputs[index]
+        return
+
+    results = {}
+    errors = {}
+    running = {}
+    next_to_yield = 0
+    waiting = list(range(len(functions)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        while waiting or running:
+            if not errors:
+                for index in list(waiting):
+                    if graph[index] <= set(results):
+                        waiting.remove(index)
+                        running[executor.submit(run, index)] = index
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                index = running.pop(future)
+                if future.exception():
+                    errors[index] = future.exception()
+                else:
+                    results[index] = future.result()
+            while next_to_yield in results and not errors:
+                yield results[next_to_yield], outputs[next_to_yield]
+                next_to_yield += 1
+
+    for index in range(next_to_yield, len(functions)):
+        if index in results:
+            yield results[index], outputs[index]
+        elif index in errors:
+            yield None, outputs[index]
+    if errors:
+        raise errors[min(errors)]
@@ -0,0 +1,213 @@
+import sys
+import json
+import time
+import collections
+import contextlib
+
+import pandas
+
+from noteql import cell_parts, make_parsers
+from noteql.cache import relation_name
+from noteql.parallel import ThreadStdout, dependencies, run_graph
+
+
+def read_cells(file_name, magic_name="nql"):
+    """Yield (origin, magic line, cell) for each `%%magic_name` cell of a
+    notebook, or for the whole of a sql file, which can have `%%magic_name`
+    lines between its statements."""
+    with open(file_name) as f:
+        if not file_name.endswith(".ipynb"):
+            cells = [(file_name, f.read())]
+        else:
+            cells = [
+                (f"cell {num}", "".join(cell["source"]))
+                for num, cell in enumerate(json.load(f)["cells"], 1)
+                if cell["cell_type"] == "code"
+            ]
+    for origin, source in cells:
+        first, _, rest = source.lstrip().partition("\n")
+        if first.split(" ")[0] == f"%%{magic_name}":
+            yield origin, first[len(magic_name) + 2:], rest
+        elif not file_name.endswith(".ipynb"):
+            yield origin, "", source
+
+
+class Step:
+    """One statement that makes tables, views or materialized views."""
+
+    def __init__(self, origin, parsed_line, sql):
+        self.origin = origin
+        self.sql = sql
+        self.targets = []
+        self.arg_params = {}
+        self.jinja = True
+        self.unique = None
+        self.force = False
+        for item in parsed_line:
+            name = item.getName()
+            if name in ("create", "view", "matview"):
+                self.targets.append((name, item[0]))
+            elif name == "arg_params":
+                self.arg_params[item[0]] = item[1]
+            elif name == "nojinja":
+                self.jinja = False
+            elif name == "unique":
+                self.unique = item[0]
+            elif name == "force":
+                self.force = True
+        self.outputs = {relation_name(target) for command, target in self.targets}
+
+    @property
+    def description(self):
+        return ", ".join(f"{command.upper()} {target}" for command, target in self.targets)
+
+    def statements(self, sql, params):
+        """(command, target, sql, params) for each thing this makes, in the
+        order the magic makes them."""
+        create = next((target for command, target in self.targets if command == "create"), None)
+        for command, target in self.targets:
+            if command == "view" and create:
+                yield command, target, f"select * from {create}", None
+            else:
+                yield command, target, sql, params
+
+
+class Pipeline:
+    """The statements of a notebook or sql file that make tables, views and
+    materialized views, run in the order of their dependencies.
+
+    Steps depend on earlier steps that make a table or view they use, and
+    run up to `workers` at once. The session is made incremental while they
+    run so steps that are up to date are skipped, unless `force` is set. Statements that make
+    nothing, such as ones that only show results, are not run. `params` are
+    the jinja context, in place of the notebook's variables.
+    """
+
+    def __init__(self, session, steps, params=None, workers=4, force=False, not_run=None):
+        self.session = session
+        self.steps = steps
+        self.params = params or {}
+        self.workers = workers
+        self.force = force
+        self.not_run = not_run or []
+        self.graph = dependencies([(step.outputs, step.sql) for step in steps])
+
+    @classmethod
+    def from_file(cls, session, file_name, **kw):
+        parsers = make_parsers(session.magic_name)
+        steps = []
+        not_run = []
+        for origin, line, cell in read_cells(file_name, session.magic_name):
+            parts = cell_parts(parsers, session.magic_name, line, cell)
+            for num, (parsed_line, sql) in enumerate(parts, 1):
+                step = Step(origin if len(parts) == 1 else f"{origin} #{num}", parsed_line, sql)
+                if step.targets:
+                    steps.append(step)
+                elif sql.strip():
+                    not_run.append(step.origin)
+        return cls(session, steps, not_run=not_run, **kw)
+
+    def render(self, step):
+        if not step.jinja:
+            return step.sql, None
+        return self.session.render(step.sql, collections.ChainMap(step.arg_params, self.params))
+
+    def run_step(self, step):
+        sql, params = self.render(step)
+        force = self.force or step.force
+        statuses = []
+        for command, target, target_sql, target_params in step.statements(sql, params):
+            if command == "create":
+                result = self.session.create_table(target, target_sql, target_params, force=force)
+            elif command == "view":
+                result = self.session.create_view(target, target_sql, target_params, force=force)
+            else:
+                result = self.session.create_materialized_view(target, target_sql, target_params, step.unique)
+            if result == "Skipped":
+                statuses.append("up to date")
+            elif command == "matview":
+                statuses.append(result.lower())
+            else:
+                statuses.append("built")
+        return ", ".join(statuses)
+
+    def report(self, statuses, seconds):
+        """Dataframe with a row for each step."""
+        return pandas.DataFrame(
+            [
+                (
+                    num,
+                    step.origin,
+                    step.description,
+                    ", ".join(str(earlier + 1) for earlier in sorted(self.graph[num - 1])),
+                    statuses.get(num - 1, "not run"),
+                    seconds.get(num - 1),
+                )
+                for num, step in enumerate(self.steps, 1)
+            ],
+            columns=["step", "origin", "makes", "after", "status", "seconds"],
+        )
+
+    @contextlib.contextmanager
+    def incremental(self):
+        """Make the session incremental, as it was before afterwards."""
+        previous = self.session.incremental
+        self.session.incremental = True
+        try:
+            yield
+        finally:
+            self.session.incremental = previous
+
+    def run(self, verbose=False):
+        """Run the steps returning the report. A step that fails stops any
+        more being started and is reported with its error."""
+        statuses = {}
+        seconds = {}
+
+        def timed(index):
+            def run():
+                start = time.perf_counter()
+                try:
+                    statuses[index] = self.run_step(self.steps[index])
+                except Exception as e:
+                    statuses[index] = f"failed: {type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"
+                    raise
+                finally:
+                    seconds[index] = time.perf_counter() - start
+            return run
+
+        functions = [timed(index) for index in range(len(self.steps))]
+        # one at a time on this thread if other threads would not see its database.
+        workers = 0 if self.session.database_per_thread() else self.workers
+        # running a query closes the preview, which the workers can not do.
+        self.session.close_preview()
+        with self.incremental(), contextlib.redirect_stdout(ThreadStdout(sys.stdout)):
+            try:
+                for result, output in run_graph(functions, self.graph, workers):
+                    if verbose:
+                        output.replay()
+            except Exception:
+                pass
+        return self.report(statuses, seconds)
+
+    def stale(self):
+        """Report of which steps would be run, without running them.
+
+        A step is stale if what it makes is not up to date or any step it
+        comes after is stale. Materialized views are always refreshed.
+        """
+        statuses = {}
+        for index, step in enumerate(self.steps):
+            sql, params = self.render(step)
+            stale = (
+                self.force
+                or step.force
+                or any(statuses[earlier] != "up to date" for earlier in self.graph[index])
+            )
+            for command, target, target_sql, target_params in step.statements(sql, params):
+                if command == "matview":
+                    stale = True
+                elif not stale:
+                    stale = not self.session.up_to_date(target, target_sql, target_params)[0]
+            statuses[index] = "stale" if stale else "up to date"
+        return self.report(statuses, {}).drop(columns="seconds")
@@ -0,0 +1,230 @@
+import json
+import datetime
+import collections
+
+import pandas
+
+from noteql.timing import fingerprint
+
+COLUMNS = [
+    "id",
+    "parent",
+    "depth",
+    "node",
+    "detail",
+    "estimated_cost",
+    "estimated_rows",
+    "actual_time",
+    "actual_rows",
+]
+
+# keys of a postgres plan node shown in its detail.
+POSTGRES_DETAIL = [
+    "Relation Name",
+    "Alias",
+    "Index Name",
+    "Join Type",
+    "Index Cond",
+    "Hash Cond",
+    "Merge Cond",
+    "Filter",
+    "Sort Key",
+    "Group Key",
+]
+
+
+def node(nodes, parent, depth, name, detail="", **values):
+    nodes.append(dict(
+        {column: None for column in COLUMNS},
+        id=len(nodes), parent=parent, depth=depth, node=name, detail=detail, **values
+    ))
+    return len(nodes) - 1
+
+
+def detail_text(values, keys):
+    """`key: value; ...` for the `keys` set in `values`, lists comma separated."""
+    return "; ".join(
+        f"{key}: {', '.join(map(str, values[key])) if isinstance(values[key], list) else values[key]}"
+        for key in keys
+        if values.get(key)
+    )
+
+
+def decode(plan):
+    """Plans come back as text or already decoded depending on the driver."""
+    if isinstance(plan, (str, bytes)):
+        return json.loads(plan)
+    return plan
+
+
+def postgres_nodes(plan, nodes=None, parent=None, depth=0):
+    """Rows for the nodes of the `Plan` of postgres `EXPLAIN (FORMAT JSON)`.
+
+    Actual time and rows are for all loops of a node, time in seconds.
+    """
+    if nodes is None:
+        nodes = []
+    loops = plan.get("Actual Loops", 1)
+    actual_time = plan.get("Actual Total Time")
+    actual_rows = plan.get("Actual Rows")
+    node_id = node(
+        nodes,
+        parent,
+        depth,
+        plan["Node Type"],
+        detail_text(plan, POSTGRES_DETAIL),
+        estimated_cost=plan.get("Total Cost"),
+        estimated_rows=plan.get("Plan Rows"),
+        actual_time=None if actual_time is None else actual_time * loops / 1000,
+        actual_rows=None if actual_rows is None else actual_rows * loops,
+    )
+    for child in plan.get("Plans", []):
+        postgres_nodes(child, nodes, node_id, depth + 1)
+    return nodes
+
+
+def duckdb_nodes(plan, nodes=None, parent=None, depth=0):
+    """Rows for the nodes of duckdb `EXPLAIN (FORMAT JSON)`, with or
+    without `ANALYZE`."""
+    if nodes is None:
+        nodes = []
+    if isinstance(plan, list):
+        for child in plan:
+            duckdb_nodes(child, nodes, parent, depth)
+        return nodes
+
+    name = plan.get("operator_name") or plan.get("name")
+    if name is None or name == "EXPLAIN_ANALYZE":
+        # the query level of the profile or the explain wrapping it.
+        duckdb_nodes(plan.get("children", []), nodes, parent, depth)
+        return nodes
+
+    extra_info = dict(plan.get("extra_info") or {})
+    estimated_rows = extra_info.pop("Estimated Cardinality", None)
+    detail = detail_text(extra_info, extra_info)
+    node_id = node(
+        nodes,
+        parent,
+        depth,
+        name.strip(),
+        detail,
+        estimated_rows=None if estimated_rows is None else float(estimated_rows.lstrip("~")),
+        actual_time=plan.get("operator_timing"),
+        actual_rows=plan.get("operator_cardinality"),
+    )
+    duckdb_nodes(plan.get("children", []), nodes, node_id, depth + 1)
+    return nodes
+
+
+def sqlite_nodes(rows):
+    """Rows for the (id, parent, notused, detail) rows of sqlite
+    `EXPLAIN QUERY PLAN`."""
+    nodes = []
+    ids = {}
+    depths = {}
+    for row_id, parent, notused, detail in rows:
+        parent = ids.get(parent)
+        depth = 0 if parent is None else depths[parent] + 1
+        ids[row_id] = node(nodes, parent, depth, detail)
+        depths[ids[row_id]] = depth
+    return nodes
+
+
+class Plan:
+    """The plan of one query.
+
+    `nodes` is a dataframe with a row per plan node, `cost` the estimated
+    cost of the whole plan and `time` the seconds the query took if it was
+    run with analyze. Engines that do not give them leave them as None.
+    """
+
+    def __init__(self, sql, nodes, cost=None, time=None, analyze=False):
+        self.sql = sql
+        self.fingerprint, self.normalized = fingerprint(sql)
+        self.nodes = pandas.DataFrame(nodes, columns=COLUMNS)
+        self.cost = cost
+        self.time = time
+        self.analyze = analyze
+        self.created = datetime.datetime.now()
+        self.regressions = []
+
+    def tree(self):
+        """`nodes` with each node indented under its parent for display."""
+        tree = self.nodes.drop(columns=["id", "parent", "depth"])
+        tree["node"] = [
+            "    " * depth + ("-> " if depth else "") + name
+            for depth, name in zip(self.nodes["depth"], self.nodes["node"])
+        ]
+        return tree.dropna(axis="columns", how="all")
+
+    def summary(self):
+        parts = []
+        if self.cost is not None:
+            parts.append(f"estimated cost {self.cost:0.2f}")
+        if self.time is not None:
+            parts.append(f"actual time {self.time:0.4f} seconds")
+        return f"Plan {self.fingerprint}" + (f": {', '.join(parts)}" if parts else "")
+
+    def __repr__(self):
+        return f"<Plan {self.fingerprint} cost={self.cost} time={self.time}>"
+
+
+class PlanHistory:
+    """Plans of the queries explained by a session, by query fingerprint.
+
+    A new plan is flagged as a regression if its estimated cost or actual
+    time is more than `threshold` times that of the last plan of the same
+    query that had one. Times have to have gone up by at least
+    `min_seconds` too, so tiny queries are not flagged for noise.
+    """
+
+    def __init__(self, threshold=1.5, min_seconds=0.01):
+        self.threshold = threshold
+        self.min_seconds = min_seconds
+        self.plans = collections.defaultdict(list)
+
+    def add(self, plan):
+        """Keep `plan`, setting and returning its regressions."""
+        previous = self.plans[plan.fingerprint]
+        last_cost = next((old.cost for old in reversed(previous) if old.cost is not None), None)
+        last_time = next((old.time for old in reversed(previous) if old.time is not None), None)
+
+        if plan.cost is not None and last_cost and plan.cost > last_cost * self.threshold:
+            plan.regressions.append(
+                f"estimated cost went from {last_cost:0.2f} to {plan.cost:0.2f}"
+            )
+        if (
+            plan.time is not None
+            and last_time is not None
+            and plan.time > last_time * self.threshold
+            and plan.time - last_time >= self.min_seconds
+        ):
+            plan.regressions.append(
+                f"actual time went from {last_time:0.4f} to {plan.time:0.4f} seconds"
+            )
+        previous.append(plan)
+        return plan.regressions
+
+    def __getitem__(self, fingerprint):
+        return self.plans[fingerprint]
+
+    def history(self, sql=None):
+        """Dataframe of the plans kept, only those of `sql` if given."""
+        plans = self.plans[fingerprint(sql)[0]] if sql else [
+            plan for plans in self.plans.values() for plan in plans
+        ]
+        return pandas.DataFrame(
+            [
+                (
+                    plan.fingerprint,
+                    plan.normalized[:100],
+                    plan.created,
+                    plan.analyze,
+                    plan.cost,
+                    plan.time,
+                    "; ".join(plan.regressions),
+                )
+                for plan in plans
+            ],
+            columns=["fingerprint", "query", "created", "analyze", "estimated_cost", "actual_time", "regressions"],
+        )
@@ -0,0 +1,168 @@
+import re
+import time
+import hashlib
+import threading
+import contextlib
+import collections
+
+import pandas
+
+# the query being timed on this thread.
+active = threading.local()
+
+
+def fingerprint(sql):
+    """Short hash and normalised text of `sql`, with literals replaced by `?`
+    so queries that only differ in their values share a fingerprint."""
+    text = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    text = re.sub(r"\b\d+(?:\.\d+)?\b", "?", text)
+    text = re.sub(r"\s+", " ", text).strip().lower()
+    return hashlib.sha1(text.encode()).hexdigest()[:12], text
+
+
+def phase(name):
+    """Context manager adding the time spent in it to `name` on the query
+    being timed on this thread, if there is one."""
+    timing = getattr(active, "timing", None)
+    if timing is None:
+        return contextlib.nullcontext()
+    return timing.phase(name)
+
+
+class QueryTiming:
+    """Seconds spent in each phase of one query.
+
+    Phases are render, parse, execute, fetch, dataframe, convert, display,
+    export, read and insert. `total` is the whole time once finished.
+    """
+
+    def __init__(self, sql, kind):
+        self.sql = sql
+        self.kind = kind
+        self.fingerprint, self.normalized = fingerprint(sql)
+        self.phases = {}
+        self.started = time.perf_counter()
+        self.total = None
+        self.error = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def elapsed(self):
+        if self.total is not None:
+            return self.total
+        return time.perf_counter() - self.started
+
+    def summary(self, note=""):
+        phases = ", ".join(f"{name} {seconds:0.4f}" for name, seconds in self.phases.items())
+        return f"Query took {self.elapsed():0.4f} seconds{note}" + (f" ({phases})" if phases else "")
+
+    def __repr__(self):
+        return f"<QueryTiming {self.kind} {self.elapsed():0.4f}s {self.phases}>"
+
+
+class Timings:
+    """Timings of the queries run by a session.
+
+    The last `max_records` are kept for `stats()` and each one is passed to
+    every function in `hooks` when it finishes, so they can be sent on to a
+    profiler.
+    """
+
+    def __init__(self, max_records=10000):
+        self.records = collections.deque(maxlen=max_records)
+        self.hooks = []
+
+    @contextlib.contextmanager
+    def query(self, sql, kind):
+        """Time a query, or add to the query already being timed on this thread."""
+        timing = getattr(active, "timing", None)
+        if timing is not None:
+            yield timing
+            return
+
+        timing = active.timing = QueryTiming(sql, kind)
+        try:
+            yield timing
+        except BaseException as e:
+            timing.error = type(e).__name__
+            raise
+        finally:
+            active.timing = None
+            self.finish(timing)
+
+    def iterate(self, sql, kind, iterable, done=None):
+        """Yield the items of `iterable`, timing making them as one query.
+
+        The query is only the one being timed on this thread while the next
+        item is made, so queries run between items are timed on their own.
+        `done` is called with the timing when the items run out.
+        """
+        timing = getattr(active, "timing", None)
+        if timing is not None:
+            yield from iterable
+            if done:
+                done(timing)
+            return
+
+        timing = QueryTiming(sql, kind)
+        iterator = iter(iterable)
+        try:
+            while True:
+                active.timing = timing
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    active.timing = None
+                yield item
+        except Exception as e:
+            timing.error = type(e).__name__
+            raise
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+            self.finish(timing)
+        if done:
+            done(timing)
+
+    def finish(self, timing):
+        """Keep a finished query's timing and pass it to the hooks.
+
+        If the query failed an error in a hook is printed rather than
+        raised, so it does not hide the query's own error.
+        """
+        timing.total = time.perf_counter() - timing.started
+        self.records.append(timing)
+        for hook in self.hooks:
+            try:
+                hook(timing)
+            except Exception as e:
+                if timing.error is None:
+                    raise
+                print(f"Error in timing hook {getattr(hook, '__name__', hook)}, {type(e).__name__}: {e}")
+
+    def stats(self):
+        """Dataframe of count, total, mean, percentiles and max seconds for
+        each phase of each query fingerprint."""
+        rows = []
+        for timing in list(self.records):
+            for name, seconds in list(timing.phases.items()) + [("total", timing.total)]:
+                rows.append((timing.fingerprint, timing.kind, timing.normalized[:100], name, seconds))
+        df = pandas.DataFrame(rows, columns=["fingerprint", "kind", "query", "phase", "seconds"])
+        grouped = df.groupby(["fingerprint", "kind", "query", "phase"], sort=False)["seconds"]
+        return pandas.DataFrame({
+            "count": grouped.count(),
+            "total": grouped.sum(),
+            "mean": grouped.mean(),
+            "p50": grouped.quantile(0.5),
+            "p90": grouped.quantile(0.9),
+            "p99": grouped.quantile(0.99),
+            "max": grouped.max(),
+        }).reset_index()
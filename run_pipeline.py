@@ -0,0 +1,39 @@
+import sys
+import noteql
+import click
+from noteql.pipeline import Pipeline
+
+
+@click.command()
+@click.option('--dburi', default='', help='sqlalchemy db uri')
+@click.option('--schema', default='', help='schema')
+@click.option('--workers', default=4, help='statements run at once')
+@click.option('--force', is_flag=True, help='rebuild everything even if up to date')
+@click.option('--dry-run', is_flag=True, help='only list which statements are stale')
+@click.option('--param', multiple=True, help='name=value given to the sql templates, can be repeated')
+@click.option('--magic-name', default='nql', help='name of the cell magic in the notebook')
+@click.option('--verbose', is_flag=True, help='show what each statement prints')
+@click.argument('file_name')
+def run_pipeline_command_line(file_name, dburi, schema, workers, force, dry_run, param, magic_name, verbose):
+    params = {}
+    for item in param:
+        name, equals, value = item.partition('=')
+        if not equals:
+            raise click.BadParameter(f'{item} is not name=value', param_hint='--param')
+        params[name] = value
+
+    session = noteql.Session(dburi, schema or None, magic_name=magic_name, incremental=True)
+    pipeline = Pipeline.from_file(session, file_name, params=params, workers=workers, force=force)
+    if pipeline.not_run:
+        print(f"Not run as they make no table or view: {', '.join(pipeline.not_run)}")
+
+    report = pipeline.stale() if dry_run else pipeline.run(verbose=verbose)
+    print(report.to_string(index=False))
+    if not dry_run:
+        print(f"Total {report['seconds'].sum():0.4f} seconds")
+    if report['status'].str.startswith('failed').any():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_pipeline_command_line()
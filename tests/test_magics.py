@@ -1,10 +1,23 @@
 from IPython.testing.globalipapp import get_ipython
 import noteql
+import pandas
 import pytest
 import tempfile
+import collections
 import csv
+import gc
+import gzip
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import http.server
+import urllib.parse
+import openpyxl
 from openpyxl import load_workbook
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import IntegrityError, OperationalError
 
 ip = get_ipython()
 ip.user_ns["session_timer"] = noteql.Session(dburi="sqlite://", cell_magic_output=True, timer=True)
@@ -13,6 +26,20 @@ ip.user_ns["session"] = noteql.Session(dburi="sqlite://", cell_magic_output=True
 
 SIMPLE_QUERY = "SELECT * FROM test WHERE length(atitle) > 1"
 
+# tests that need postgres run when this is set to a sqlalchemy uri for it.
+POSTGRES = os.environ.get("NOTEQL_TEST_POSTGRES")
+
+
+@pytest.fixture
+def postgres_session():
+    if not POSTGRES:
+        pytest.skip("NOTEQL_TEST_POSTGRES is not set")
+    session = noteql.Session(dburi=POSTGRES, schema="noteql_test", drop_schema=True, cell_magic_output=True)
+    yield session
+    session.close()
+    session.get_results("DROP SCHEMA noteql_test CASCADE")
+    ip.user_ns["session"].set()
+
 
 def create_test_table():
     dfs = ip.run_cell_magic(
@@ -184,6 +211,24 @@ def test_csv():
             reader = csv.reader(f)
             assert list(reader) == [["atitle", "btitle"], ["aa", "bb"], ["aaa", "bbb"]]
 
+        out_csv = f"{tmpdirname}/out.csv.gz"
+        ip.run_cell_magic("nql", f"CSV {out_csv}", SIMPLE_QUERY + " ORDER BY atitle")
+        with gzip.open(out_csv, "rt") as f:
+            assert f.read() == "atitle,btitle\naa,bb\naaa,bbb\n"
+
+        # with other targets the statement is only run once.
+        ip.run_cell_magic("nql", "", "CREATE TABLE inserted (a int)")
+        out_csv = f"{tmpdirname}/inserted.csv"
+        out_xlsx = f"{tmpdirname}/inserted.xlsx"
+        ip.run_cell_magic(
+            "nql", f"CSV {out_csv} EXCEL {out_xlsx} new=ROWS", "INSERT INTO inserted VALUES (1), (2) RETURNING a"
+        )
+        assert ip.user_ns["new"] == [[1], [2]]
+        with open(out_csv) as f:
+            assert f.read() == "a\n1\n2\n"
+        assert list(load_workbook(filename=out_xlsx)["Sheet"].values) == [("a",), (1,), (2,)]
+        assert ip.user_ns["session"].get_dataframe("SELECT count(*) n FROM inserted")["n"].tolist() == [2]
+
 
 def test_xlsx():
     create_test_table()
@@ -203,6 +248,59 @@ def test_xlsx():
         assert list(wb['moo'].values) == [("atitle", "btitle"), ("aa", "bb"), ("aaa", "bbb")]
 
         pytest.raises(Exception, ip.run_cell_magic, "nql", f"EXCEL {out_xlsx} TITLE moo", SIMPLE_QUERY)
+        wb = load_workbook(filename=out_xlsx)
+        assert wb.sheetnames == ['Sheet', 'moo']
+
+        out_xlsx = f"{tmpdirname}/cell.xlsx"
+        ip.run_cell_magic(
+            "nql",
+            f"EXCEL {out_xlsx} TITLE one",
+            SIMPLE_QUERY + f"\n%%nql EXCEL {out_xlsx} TITLE two SHOW\n" + SIMPLE_QUERY,
+        )
+        wb = load_workbook(filename=out_xlsx)
+        assert wb.sheetnames == ['one', 'two']
+        assert list(wb['two'].values) == [("atitle", "btitle"), ("aa", "bb"), ("aaa", "bbb")]
+
+        # a cell that fails does not save the sheets it added.
+        pytest.raises(
+            Exception,
+            ip.run_cell_magic,
+            "nql",
+            f"EXCEL {out_xlsx} TITLE three",
+            SIMPLE_QUERY + "\n%%nql\nSELECT * FROM not_a_table",
+        )
+        assert load_workbook(filename=out_xlsx).sheetnames == ['one', 'two']
+
+        # sheets in a file made elsewhere keep their formatting.
+        out_xlsx = f"{tmpdirname}/styled.xlsx"
+        wb = openpyxl.Workbook()
+        wb.active.title = "styled"
+        wb.active["A1"] = 1.5
+        wb.active["A1"].number_format = "0.00%"
+        wb.active["A1"].font = openpyxl.styles.Font(bold=True)
+        wb.active["A2"] = "=A1*2"
+        wb.active.merge_cells("B1:C1")
+        wb.active.column_dimensions["A"].width = 30
+        wb.save(out_xlsx)
+        ip.run_cell_magic("nql", f"EXCEL {out_xlsx} TITLE added", SIMPLE_QUERY)
+        wb = load_workbook(filename=out_xlsx)
+        assert wb.sheetnames == ['styled', 'added']
+        styled = wb["styled"]
+        assert styled["A1"].number_format == "0.00%" and styled["A1"].font.bold
+        assert styled["A2"].value == "=A1*2"
+        assert [str(cells) for cells in styled.merged_cells.ranges] == ["B1:C1"]
+        assert styled.column_dimensions["A"].width == 30
+
+        session = ip.user_ns["session"]
+        out_xlsx = f"{tmpdirname}/session.xlsx"
+        report = session.excel_workbook(out_xlsx)
+        ip.run_cell_magic("nql", f"EXCEL {out_xlsx} TITLE one", SIMPLE_QUERY)
+        ip.run_cell_magic("nql", f"EXCEL {out_xlsx} TITLE two", SIMPLE_QUERY)
+        assert not os.path.exists(out_xlsx)
+        report.save()
+        assert not session.workbooks
+        wb = load_workbook(filename=out_xlsx)
+        assert wb.sheetnames == ['one', 'two']
 
 
 def test_timer(capsys):
@@ -233,3 +331,766 @@ def test_timer(capsys):
     ip.run_cell_magic("nql", "SESSION session", SIMPLE_QUERY)
     captured = capsys.readouterr()
     assert not captured.out.startswith("Query took")
+
+
+def test_load_json():
+    session = ip.user_ns["session"]
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        json_file = f"{tmpdirname}/releases.json"
+        with open(json_file, "w") as f:
+            json.dump({"releases": [{"ocid": str(num), "value": num + 0.5} for num in range(25)]}, f)
+
+        session.load_json(json_file, "releases", overwrite=True, batch_size=10)
+
+    df = session.get_dataframe(
+        "SELECT count(*) total, max(id) max_id, sum(json_extract(releases, '$.value')) value FROM releases"
+    )
+    assert df.to_dict("records") == [{"total": 25, "max_id": 25, "value": 312.5}]
+
+
+def test_load_many():
+    session = ip.user_ns["session"]
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        for month in range(3):
+            with open(f"{tmpdirname}/2021-0{month}.json", "w") as f:
+                json.dump([{"month": month, "num": num} for num in range(10)], f)
+        with open(f"{tmpdirname}/2021-09.json", "w") as f:
+            f.write('[{"month": 9}, ')
+
+        report = session.load_many(f"{tmpdirname}/2021-*.json", table_name="monthly", overwrite=True)
+
+    assert list(report["rows"][:3]) == [10, 10, 10]
+    assert report["error"][:3].isnull().all()
+    assert report["error"][3].startswith("IncompleteJSONError")
+
+    df = session.get_dataframe("SELECT count(*) total FROM monthly")
+    assert df.to_dict("records") == [{"total": 30}]
+
+    # nothing is appended to the old table when the first file fails.
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        with open(f"{tmpdirname}/2022-00.json", "w") as f:
+            f.write('[{"month": 0}, ')
+        with open(f"{tmpdirname}/2022-01.json", "w") as f:
+            json.dump([{"month": 99, "num": 1}], f)
+
+        report = session.load_many(f"{tmpdirname}/2022-*.json", table_name="monthly", overwrite=True)
+
+    assert report["error"][0].startswith("IncompleteJSONError")
+    assert report["error"][1] == f"Skipped as {tmpdirname}/2022-00.json failed"
+    df = session.get_dataframe("SELECT count(*) total FROM monthly WHERE json_extract(json, '$.month') = 99")
+    assert df.to_dict("records") == [{"total": 0}]
+
+
+def test_load_xml():
+    session = ip.user_ns["session"]
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        xml_file = f"{tmpdirname}/activities.xml"
+        with open(xml_file, "w") as f:
+            f.write("<activities>")
+            for num in range(5):
+                f.write(f"<activity><id>{num}</id></activity>")
+            f.write("</activities>")
+
+        session.load_xml(xml_file, "activity", json_field="json", overwrite=True)
+        session.load_xml(xml_file, "activity", json_field="json", table_name="pooled", overwrite=True, workers=2)
+
+    df = session.get_dataframe("""SELECT activity, json_extract(json, '$.activity.id."#text"') id FROM activities""")
+    assert df.to_dict("records")[1] == {"activity": "<activity><id>1</id></activity>", "id": "1"}
+    assert len(df) == 5
+
+    pooled = session.get_dataframe("""SELECT activity, json_extract(json, '$.activity.id."#text"') id FROM pooled""")
+    assert pooled.to_dict("records") == df.to_dict("records")
+
+
+def test_iter_elements():
+    xml = b"<root><header/><a><b>1</b></a><a><b>2</b><a><b>3</b></a></a></root>"
+
+    seen = []
+    for elem in noteql.iter_elements(io.BytesIO(xml), "a"):
+        seen.append(elem.xpath("string()"))
+        root = elem.getroottree().getroot()
+
+    # nested match keeps its content for the outer element.
+    assert seen == ["1", "3", "23"]
+    # everything used has been freed from the tree.
+    assert len(root) == 1 and len(root[0]) == 0
+
+
+def test_parsers_cached():
+    session = ip.user_ns["session"]
+    magics = ip.magics_manager.registry["Noteql"]
+
+    assert magics.get_parsers(session) is magics.get_parsers(session)
+
+    # magic lines after tabs or leading whitespace split the cell as the grammar does.
+    ip.run_cell_magic("nql", "first=CELL", "select 1\n%%nql\tsecond=CELL\nselect 2\n  \t%%nql third=CELL\nselect 3")
+    assert [ip.user_ns[name] for name in ["first", "second", "third"]] == [1, 2, 3]
+    ip.run_cell_magic("nql", "whole=SQL", "select '%%nql' as a, 1 %%nqlx\n")
+    assert ip.user_ns["whole"] == "select '%%nql' as a, 1 %%nqlx"
+
+
+def test_render():
+    session = ip.user_ns["session"]
+
+    assert session.render("SELECT 1\n", {}) == ("SELECT 1", None)
+
+    sql, params = session.render(
+        "SELECT {{a}} {% for i in range(2) %}, {{i}}{% endfor %}",
+        collections.ChainMap({"a": "x"}, {"a": "y"}),
+    )
+    assert sql == "SELECT ? , ?, ?"
+    assert params == ["x", 0, 1]
+
+    ip.user_ns["my_variable"] = "aa"
+    dfs = ip.run_cell_magic("nql", "my_variable='aaa'", SIMPLE_QUERY + " and atitle={{my_variable}}")
+    assert dfs[0].to_dict("list") == {"atitle": ["aaa"], "btitle": ["bbb"]}
+
+
+def test_latest_session():
+    ip.user_ns["session"].set()
+    temporary = noteql.Session(dburi="sqlite://")
+    assert noteql.get_latest_session() is temporary
+
+    del temporary
+    gc.collect()
+    assert noteql.get_latest_session() is ip.user_ns["session"]
+
+    # sessions with a preview, background queries and workbooks go as soon as they are deleted.
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        gc.disable()
+        try:
+            temporary = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite", cell_magic_output=True, preview_rows=1)
+            ip.run_cell_magic("nql", "", "SELECT 1 a UNION ALL SELECT 2")
+            assert temporary.preview is not None
+            temporary.submit("SELECT 1").result(timeout=10)
+            temporary.excel_workbook(f"{tmpdirname}/book.xlsx")
+            del temporary
+            assert noteql.get_latest_session() is ip.user_ns["session"]
+        finally:
+            gc.enable()
+
+    # closing a session stops the magics using it.
+    temporary = noteql.Session(dburi="sqlite://")
+    temporary.close()
+    assert noteql.get_latest_session() is ip.user_ns["session"]
+
+
+def test_cache():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cached = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite", cache=True, cache_dir=f"{tmpdirname}/cache",
+                                cell_magic_output=True)
+        create_test_table()
+        assert cached.get_dataframe(SIMPLE_QUERY)["atitle"].tolist() == ["aa", "aaa"]
+
+        # change the table behind the cache's back
+        with cached.engine.begin() as connection:
+            connection.execute("INSERT INTO test VALUES ('aaaa', 'bbbb')")
+
+        dfs = ip.run_cell_magic("nql", "", SIMPLE_QUERY)
+        assert dfs[0]["atitle"].tolist() == ["aa", "aaa"]
+        dfs = ip.run_cell_magic("nql", "NOCACHE", SIMPLE_QUERY)
+        assert dfs[0]["atitle"].tolist() == ["aa", "aaa", "aaaa"]
+
+        # survives a restart
+        restarted = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite", cache_dir=f"{tmpdirname}/cache")
+        assert restarted.get_dataframe(SIMPLE_QUERY)["atitle"].tolist() == ["aa", "aaa"]
+
+        # creating the table again removes cached results that use it
+        cached.set()
+        create_test_table()
+        assert not cached.cache.entries
+        assert not cached.cache.disk_index
+
+        # statements other than queries are never cached and drop the cache even if they return rows.
+        count = "SELECT count(*) n FROM test"
+        assert cached.get_dataframe(count)["n"].tolist() == [3]
+        for num in range(2):
+            dfs = ip.run_cell_magic("nql", "", "INSERT INTO test VALUES ('returned', 'b') RETURNING atitle")
+            assert dfs[0]["atitle"].tolist() == ["returned"]
+        assert cached.get_dataframe(count)["n"].tolist() == [5]
+        cached.get_rows("DELETE FROM test WHERE atitle = 'returned' RETURNING atitle", cache=False)
+        assert cached.get_dataframe(count)["n"].tolist() == [3]
+
+        del cached, restarted
+        ip.user_ns["session"].set()
+
+
+def test_cache_threads():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache = noteql.ResultCache(max_bytes=20000, directory=tmpdirname)
+
+        def use(thread):
+            for num in range(50):
+                key = cache.key(thread, num % 7)
+                cache.put(key, f"SELECT {num}", pandas.DataFrame({"a": range(num)}))
+                cache.get(cache.key(thread, num % 5))
+                if num % 10 == 0:
+                    cache.invalidate("other")
+
+        threads = [threading.Thread(target=use, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert cache.total_bytes == sum(size for sql, df, size in cache.entries.values()) <= cache.max_bytes
+        with open(os.path.join(tmpdirname, "index.json")) as f:
+            assert json.load(f) == cache.disk_index
+        assert sorted(os.listdir(tmpdirname)) == sorted([key + ".pickle" for key in cache.disk_index] + ["index.json"])
+
+
+def test_chunks():
+    create_test_table()
+
+    session = ip.user_ns["session"]
+    chunks = list(session.iter_dataframes("SELECT * FROM test ORDER BY atitle", chunksize=2))
+    assert [chunk.to_dict("list") for chunk in chunks] == [
+        {"atitle": ["a", "aa"], "btitle": ["b", "bb"]},
+        {"atitle": ["aaa"], "btitle": ["bbb"]},
+    ]
+
+    ip.run_cell_magic("nql", "chunks=CHUNKS", SIMPLE_QUERY)
+    assert pandas.concat(ip.user_ns["chunks"]).to_dict("list") == {"atitle": ["aa", "aaa"], "btitle": ["bb", "bbb"]}
+
+
+def test_arrow():
+    pytest.importorskip("pyarrow")
+    create_test_table()
+
+    session = ip.user_ns["session"]
+    df = session.get_dataframe(SIMPLE_QUERY + " ORDER BY atitle", arrow=True)
+    assert str(df.dtypes["atitle"]) == "string[pyarrow]"
+    assert df.to_dict("list") == {"atitle": ["aa", "aaa"], "btitle": ["bb", "bbb"]}
+
+    df = session.get_dataframe("SELECT 1 a, 'x' b UNION ALL SELECT 'y', null", arrow=True)
+    assert df.to_dict("list") == {"a": ["1", "y"], "b": ["x", None]}
+
+
+def test_preview():
+    create_test_table()
+
+    session = ip.user_ns["session"]
+    session.preview_rows = 2
+    try:
+        dfs = ip.run_cell_magic("nql", "", "SELECT * FROM test ORDER BY atitle")
+        assert dfs[0]["atitle"].tolist() == ["a", "aa"]
+        assert session.preview.total == 3
+        assert session.preview.next_page()["atitle"].tolist() == ["aaa"]
+        assert session.preview.next_page() is None
+
+        # running anything else closes the preview.
+        ip.run_cell_magic("nql", "", "SELECT * FROM test ORDER BY atitle")
+        session.get_dataframe("SELECT 1")
+        assert session.preview is None
+    finally:
+        session.preview_rows = 1000
+
+    # the preview holds no transaction, so other connections can write while it is shown.
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        previewed = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite", cell_magic_output=True)
+        previewed.get_results(
+            "CREATE TABLE numbers AS WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r WHERE i < 5000) SELECT i FROM r"
+        )
+        dfs = ip.run_cell_magic("nql", "", "SELECT i FROM numbers ORDER BY i")
+        assert len(dfs[0]) == 1000 and previewed.preview is not None
+        writer = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite")
+        writer.get_results("INSERT INTO numbers VALUES (5001)")
+        assert previewed.preview.next_page()["i"].tolist() == list(range(1001, 2001))
+        assert previewed.preview.total == 5001
+
+        # statements that are not queries are run once rather than previewed.
+        previewed.set()
+        dfs = ip.run_cell_magic("nql", "", "INSERT INTO numbers VALUES (5002) RETURNING i")
+        assert dfs[0]["i"].tolist() == [5002] and previewed.preview is None
+        del previewed, writer, dfs
+        ip.user_ns["session"].set()
+
+
+def test_row_targets():
+    create_test_table()
+
+    ip.run_cell_magic("nql", "cell=CELL record=RECORD", "SELECT null a, 1 b UNION ALL SELECT 2, 3")
+    assert ip.user_ns["cell"] is None
+    assert ip.user_ns["record"] == {"a": None, "b": 1}
+
+    ip.run_cell_magic("nql", "headings=HEADINGS cols=COLS", SIMPLE_QUERY + " AND atitle = 'x'")
+    assert ip.user_ns["headings"] == ["atitle", "btitle"]
+    assert ip.user_ns["cols"] == [[], []]
+
+
+class StandInDatasette(http.server.BaseHTTPRequestHandler):
+    """Enough of the Datasette json api for the client, serving an in memory
+    sqlite database as /data.json with max_returned_rows of 2."""
+
+    protocol_version = "HTTP/1.1"
+    max_returned_rows = 2
+    connections = 0
+    requests = 0
+    queries = []
+
+    def setup(self):
+        super().setup()
+        StandInDatasette.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        StandInDatasette.requests += 1
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        database = sqlite3.connect(":memory:")
+        database.execute("create table numbers as with recursive r(i) as (select 1 union all select i + 1 from r where i < 5) select i from r")
+        if url.path == "/data.json" and "sql" in params:
+            query_params = {key: value for key, value in params.items() if not key.startswith("_") and key != "sql"}
+            StandInDatasette.queries.append(params["sql"])
+            cursor = database.execute(params["sql"], query_params)
+            rows = cursor.fetchmany(self.max_returned_rows + 1)
+            body = {
+                "columns": [column[0] for column in cursor.description],
+                "rows": [list(row) for row in rows[:self.max_returned_rows]],
+                "truncated": len(rows) > self.max_returned_rows,
+            }
+        elif url.path == "/data.json":
+            body = {"tables": [{"name": "numbers", "columns": ["i"], "count": 5, "hidden": False}]}
+        elif url.path == "/data/numbers.json":
+            after = int(params.get("_next", 0))
+            rows = database.execute("select i from numbers where i > ? order by i limit 2", [after]).fetchall()
+            body = {"columns": ["i"], "rows": [list(row) for row in rows], "next_url": None}
+            if rows and rows[-1][0] < 5:
+                body["next_url"] = f"http://localhost/data/numbers.json?_next={rows[-1][0]}"
+        else:
+            body = {"ok": False}
+        content = json.dumps(body).encode()
+        self.send_response(200 if body.get("ok", True) else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def test_datasette():
+    server = http.server.ThreadingHTTPServer(("localhost", 0), StandInDatasette)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        datasette = noteql.Session(datasette_url=f"http://localhost:{server.server_port}/data.json", datasette_workers=2)
+
+        df = datasette.get_dataframe("select i from numbers order by i")
+        assert df["i"].tolist() == [1, 2, 3, 4, 5]
+        assert StandInDatasette.requests == 3
+
+        df = datasette.get_dataframe("select i from numbers where i > cast(:above as integer)", params={"above": 3})
+        assert df["i"].tolist() == [4, 5]
+
+        # without an order by of its own the query is paged in the order of its columns.
+        StandInDatasette.queries.clear()
+        df = datasette.get_dataframe("select i from (select i from numbers order by i desc)")
+        assert df["i"].tolist() == [1, 2, 3, 4, 5]
+        assert all(query.endswith("order by 1 limit 2 offset " + query.split()[-1]) for query in StandInDatasette.queries[1:])
+
+        chunks = list(datasette.iter_dataframes("select i from numbers order by i", chunksize=3))
+        assert [chunk["i"].tolist() for chunk in chunks] == [[1, 2, 3], [4, 5]]
+
+        assert datasette.datasette.get_table("numbers")["i"].tolist() == [1, 2, 3, 4, 5]
+        assert datasette.tables().to_dict("records") == [{"name": "numbers", "count": 5, "fields": "i"}]
+        assert datasette.fields("numbers").to_dict("records") == [{"name": "i", "type": "TEXT"}]
+
+        # connections are kept alive between requests.
+        assert StandInDatasette.connections < StandInDatasette.requests / 2
+        ip.user_ns["session"].set()
+    finally:
+        server.shutdown()
+
+
+def test_persistent():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        persistent = noteql.Session(
+            dburi=f"sqlite:///{tmpdirname}/db.sqlite", cell_magic_output=True, persistent=True,
+            settings={"cache_size": -4096},
+        )
+        ip.run_cell_magic("nql", "", "CREATE TEMP TABLE scratch AS SELECT 1 a")
+        ip.run_cell_magic("nql", "value=CELL", "SELECT a FROM scratch")
+        assert ip.user_ns["value"] == 1
+        assert persistent.get_dataframe("PRAGMA cache_size").iloc[0, 0] == -4096
+
+        # the connection is made again if it is lost.
+        persistent.connection.invalidate()
+        assert persistent.get_dataframe("SELECT 2 b")["b"].tolist() == [2]
+        assert persistent.get_dataframe("PRAGMA cache_size").iloc[0, 0] == -4096
+
+        persistent.close()
+        del persistent
+        ip.user_ns["session"].set()
+
+
+def test_async():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        background = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite", cell_magic_output=True)
+        dfs = ip.run_cell_magic("nql", "ASYNC CREATE numbers result=DF", "SELECT 1 a UNION ALL SELECT 2")
+        handle = dfs[0]
+        assert handle.result(timeout=10)["a"].tolist() == [1, 2]
+        assert handle.status == "done"
+        assert ip.user_ns["result"]["a"].tolist() == [1, 2]
+        assert background.get_dataframe("SELECT count(*) n FROM numbers")["n"].tolist() == [2]
+
+        # the open cursor of a preview shown in the cell would lock the write.
+        background.preview_rows = 1
+        ip.run_cell_magic("nql", "", "SELECT * FROM numbers")
+        assert background.preview is not None
+        copy = background.submit("SELECT a FROM numbers", create="copied")
+        copy.result(timeout=10)
+        assert background.get_dataframe("SELECT count(*) n FROM copied")["n"].tolist() == [2]
+
+        handle = background.submit(
+            "WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r) SELECT count(*) FROM r"
+        )
+        while handle.elapsed < 0.2:
+            time.sleep(0.05)
+        assert handle.cancel()
+        pytest.raises(Exception, handle.result, 10)
+        assert handle.status == "cancelled"
+        assert background.jobs == [dfs[0], copy, handle]
+
+        del background, dfs, copy, handle
+        ip.user_ns["session"].set()
+
+
+def test_parallel(capsys):
+    statements = [
+        ({"a"}, "SELECT 1 x"),
+        ({"b"}, "SELECT 2 x"),
+        ({"c"}, "SELECT * FROM a JOIN b USING (x)"),
+        ({"a"}, "SELECT 3 x"),
+        (set(), "SELECT * FROM b"),
+    ]
+    assert noteql.parallel.dependencies(statements) == [set(), set(), {0, 1}, {0, 2}, {1}]
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        parallel = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite", cell_magic_output=True)
+        capsys.readouterr()
+        dfs = ip.run_cell_magic(
+            "nql",
+            "PARALLEL CREATE first",
+            "SELECT 1 x\n"
+            "%%nql CREATE second\n"
+            "SELECT 2 x\n"
+            "%%nql both=DF SHOW\n"
+            "SELECT x AS both_x FROM first UNION ALL SELECT * FROM second ORDER BY 1\n"
+            "%%nql\n"
+            "SELECT 3 last_x\n",
+        )
+        assert ip.user_ns["both"]["both_x"].tolist() == [1, 2]
+        assert [df if df is None else df.iloc[:, 0].tolist() for df in dfs] == [None, None, [1, 2], [3]]
+        output = capsys.readouterr().out
+        assert output.index("both_x") < output.index("last_x")
+
+        # a preview left open by a bare SELECT would lock out the writes.
+        parallel.preview_rows = 1
+        ip.run_cell_magic("nql", "", "SELECT x FROM first UNION ALL SELECT x FROM second")
+        assert parallel.preview is not None
+        ip.run_cell_magic("nql", "PARALLEL CREATE third", "SELECT 3 x\n%%nql CREATE fourth\nSELECT 4 x\n")
+        assert parallel.get_dataframe("SELECT x FROM third UNION ALL SELECT x FROM fourth ORDER BY 1")["x"].tolist() == [3, 4]
+
+        del parallel, dfs
+        ip.user_ns["session"].set()
+
+
+def test_stats(capsys):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        timed = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite", cell_magic_output=True, timer=True)
+        finished = []
+        timed.add_timing_hook(finished.append)
+
+        for value in (1, 2, 3):
+            ip.run_cell_magic("nql", "numbers=DF", f"SELECT {value} a")
+        output = capsys.readouterr().out
+        seconds = [float(line.split()[2]) for line in output.splitlines() if line.startswith("Query took")]
+        assert len(seconds) == 3 and min(seconds) >= 0
+
+        assert [timing.kind for timing in finished] == ["parse", "magic"] * 3
+        assert {"render", "execute", "fetch", "dataframe", "convert"} <= set(finished[1].phases)
+
+        stats = timed.stats()
+        magic = stats[stats["kind"] == "magic"]
+        # literals are left out of the fingerprint so the three queries are one.
+        assert magic["fingerprint"].nunique() == 1
+        assert magic.set_index("phase").loc["total", "count"] == 3
+        assert list(stats.columns) == [
+            "fingerprint", "kind", "query", "phase", "count", "total", "mean", "p50", "p90", "p99", "max"
+        ]
+
+        # rows fetched as they are needed are timed as one query, apart from queries run between them.
+        finished.clear()
+        rows = timed.iter_rows("SELECT 1 a UNION ALL SELECT 2")
+        assert next(rows) == ("a",)
+        timed.get_dataframe("SELECT 3 b")
+        assert list(rows) == [(1,), (2,)]
+        assert [timing.kind for timing in finished] == ["get_dataframe", "iter_rows"]
+        assert {"execute", "fetch"} <= set(finished[1].phases)
+
+        # a failing hook does not hide the query's error.
+        def failing_hook(timing):
+            raise ValueError("hook failed")
+
+        timed.add_timing_hook(failing_hook)
+        with pytest.raises(OperationalError):
+            timed.get_dataframe("SELECT * FROM not_a_table")
+        assert "Error in timing hook failing_hook, ValueError: hook failed" in capsys.readouterr().out
+        pytest.raises(ValueError, timed.get_dataframe, "SELECT 1")
+        timed.timings.hooks.remove(failing_hook)
+
+        del timed
+        ip.user_ns["session"].set()
+
+
+def test_explain(capsys):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        explained = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite", cell_magic_output=True)
+        explained.get_results("CREATE TABLE numbers AS SELECT 1 a UNION ALL SELECT 2")
+        ip.user_ns["above"] = 1
+        capsys.readouterr()
+
+        dfs = ip.run_cell_magic("nql", "plan=DF EXPLAIN", "SELECT * FROM numbers WHERE a > {{ above }}")
+        assert ip.user_ns["plan"]["node"].tolist() == ["SCAN numbers"]
+        assert dfs[0] is ip.user_ns["plan"]
+        assert capsys.readouterr().out.startswith("Plan ")
+
+        ip.run_cell_magic("nql", "ANALYZE", "SELECT * FROM numbers WHERE a > {{ above }}")
+        history = explained.plans.history("SELECT * FROM numbers WHERE a > ?")
+        assert history["analyze"].tolist() == [False, True]
+        assert history["actual_time"].notna().tolist() == [False, True]
+
+        # EXPLAIN does not run the statement.
+        assert ip.run_cell_magic("nql", "EXPLAIN CREATE more", "SELECT 1") == [None]
+        assert "can not be used with CREATE" in capsys.readouterr().out
+
+        history = noteql.plans.PlanHistory(threshold=1.5, min_seconds=0.01)
+        assert history.add(noteql.plans.Plan("SELECT 1", [], cost=10, time=0.1)) == []
+        assert history.add(noteql.plans.Plan("SELECT 2", [], cost=12, time=0.105)) == []
+        assert history.add(noteql.plans.Plan("SELECT 3", [], cost=20)) == [
+            "estimated cost went from 12.00 to 20.00"
+        ]
+        assert history.add(noteql.plans.Plan("SELECT 4", [], time=0.2)) == [
+            "actual time went from 0.1050 to 0.2000 seconds"
+        ]
+        assert len(history.history()) == 4
+
+        del explained, dfs
+        ip.user_ns["session"].set()
+
+
+def test_incremental(capsys):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        incremental = noteql.Session(
+            dburi=f"sqlite:///{tmpdirname}/db.sqlite", cell_magic_output=True, incremental=True
+        )
+        incremental.get_results("CREATE TABLE source AS SELECT 1 a")
+        capsys.readouterr()
+
+        def build():
+            ip.run_cell_magic("nql", "CREATE derived", "SELECT a FROM source")
+            ip.run_cell_magic("nql", "CREATE second", "SELECT count(*) n FROM derived")
+            return capsys.readouterr().out
+
+        assert "up to date" not in build()
+        assert build().count("up to date, not rebuilt") == 2
+
+        # a change upstream rebuilds everything downstream of it.
+        incremental.get_results("INSERT INTO source VALUES (2)")
+        assert "up to date" not in build()
+        assert incremental.get_dataframe("SELECT n FROM second")["n"].tolist() == [2]
+
+        ip.run_cell_magic("nql", "CREATE second FORCE", "SELECT count(*) n FROM derived")
+        assert "up to date" not in capsys.readouterr().out
+
+        # so is a table that has been dropped.
+        incremental.get_results("DROP TABLE second")
+        assert build().count("up to date, not rebuilt") == 1
+        assert incremental.get_dataframe("SELECT relation FROM noteql_builds ORDER BY 1")["relation"].tolist() == [
+            "derived", "second"
+        ]
+
+        # sqlite checks the rows themselves so changes that keep the count are noticed.
+        incremental.get_results("UPDATE source SET a = 3 WHERE a = 2")
+        assert "up to date" not in build()
+
+        # as are tables named with their schema, here an attached database.
+        attached = noteql.Session(dburi=f"sqlite:///{tmpdirname}/main.sqlite", incremental=True, persistent=True)
+        attached.get_results(f"ATTACH DATABASE '{tmpdirname}/other.sqlite' AS other")
+        attached.get_results("CREATE TABLE other.raw AS SELECT 1 a")
+        assert attached.create_table("from_other", "SELECT a FROM other.raw") != "Skipped"
+        assert attached.create_table("from_other", "SELECT a FROM other.raw") == "Skipped"
+        attached.get_results("UPDATE other.raw SET a = 2")
+        assert attached.create_table("from_other", "SELECT a FROM other.raw") != "Skipped"
+        attached.close()
+
+        del incremental, attached
+        ip.user_ns["session"].set()
+
+
+def test_matview():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        materialized = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite", cell_magic_output=True)
+        materialized.get_results("CREATE TABLE source AS SELECT 1 a")
+        ip.run_cell_magic("nql", "MATVIEW totals UNIQUE a", "SELECT a, count(*) n FROM source GROUP BY a")
+
+        materialized.get_results("INSERT INTO source VALUES (2)")
+        # sqlite has no materialized views so the table is rebuilt and swapped in.
+        assert materialized.create_materialized_view(
+            "totals", "SELECT a, count(*) n FROM source GROUP BY a", unique="a"
+        ) == "Swapped"
+        assert materialized.get_dataframe("SELECT * FROM totals ORDER BY a").values.tolist() == [[1, 1], [2, 1]]
+        objects = materialized.get_dataframe("SELECT type, name, tbl_name FROM sqlite_master ORDER BY 1, 2")
+        assert objects.values.tolist() == [
+            ["index", "totals_unique", "totals"], ["table", "source", "source"], ["table", "totals", "totals"]
+        ]
+        pytest.raises(IntegrityError, materialized.get_results, "INSERT INTO totals VALUES (1, 1)")
+
+        # a table or view of the same name is replaced.
+        ip.run_cell_magic("nql", "VIEW was_view", "SELECT a FROM source")
+        ip.run_cell_magic("nql", "MATVIEW was_view", "SELECT a FROM source")
+        ip.run_cell_magic("nql", "CREATE was_table", "SELECT a FROM source")
+        ip.run_cell_magic("nql", "MATVIEW was_table", "SELECT a FROM source")
+        objects = materialized.get_dataframe("SELECT name, type FROM sqlite_master WHERE name LIKE 'was%' ORDER BY 1")
+        assert objects.values.tolist() == [["was_table", "table"], ["was_view", "table"]]
+        ip.run_cell_magic("nql", "VIEW was_table", "SELECT a FROM source")
+        assert materialized.get_dataframe("SELECT type FROM sqlite_master WHERE name = 'was_table'")["type"].tolist() == ["view"]
+
+        del materialized
+        ip.user_ns["session"].set()
+
+
+def test_pipeline():
+    from noteql.pipeline import Pipeline
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        notebook = os.path.join(tmpdirname, "pipeline.ipynb")
+        cells = [
+            ["import noteql"],
+            ["%%nql CREATE source\n", "SELECT {{ start }} a\n", "%%nql CREATE derived\n", "SELECT a + 1 b FROM source"],
+            ["%%nql VIEW latest\n", "SELECT max(b) b FROM derived"],
+            ["%%nql CREATE other\n", "SELECT 1 c"],
+            ["%%nql\n", "SELECT * FROM latest"],
+        ]
+        with open(notebook, "w") as f:
+            json.dump({"cells": [{"cell_type": "code", "source": source} for source in cells]}, f)
+
+        pipeline_session = noteql.Session(dburi=f"sqlite:///{tmpdirname}/db.sqlite")
+
+        def pipeline(**kw):
+            return Pipeline.from_file(pipeline_session, notebook, params={"start": 1}, **kw)
+
+        assert pipeline().not_run == ["cell 5"]
+        pipeline_session.preview_rows = 1
+        ip.run_cell_magic("nql", "", "SELECT 1 a UNION ALL SELECT 2")
+        assert pipeline_session.preview is not None
+        report = pipeline().run()
+        # the session is only incremental while the pipeline runs, and its preview is closed.
+        assert not pipeline_session.incremental
+        assert pipeline_session.preview is None
+        assert report[["origin", "makes", "after", "status"]].values.tolist() == [
+            ["cell 2 #1", "CREATE source", "", "built"],
+            ["cell 2 #2", "CREATE derived", "1", "built"],
+            ["cell 3", "VIEW latest", "2", "built"],
+            ["cell 4", "CREATE other", "", "built"],
+        ]
+        assert pipeline_session.get_dataframe("SELECT b FROM latest")["b"].tolist() == [2]
+        assert pipeline().run()["status"].tolist() == ["up to date"] * 4
+
+        # a new param makes everything downstream of it stale.
+        changed = Pipeline.from_file(pipeline_session, notebook, params={"start": 5})
+        assert changed.stale()["status"].tolist() == ["stale", "stale", "stale", "up to date"]
+        assert changed.run()["status"].tolist() == ["built", "built", "built", "up to date"]
+        assert pipeline_session.get_dataframe("SELECT b FROM latest")["b"].tolist() == [6]
+        assert pipeline(force=True).run()["status"].tolist() == ["built"] * 4
+
+        # sql files can have many statements, and a failure stops the ones after it.
+        sql_file = os.path.join(tmpdirname, "pipeline.sql")
+        with open(sql_file, "w") as f:
+            f.write("%%nql CREATE first\nSELECT 1 a\n%%nql CREATE broken\nSELECT * FROM nothere\n"
+                    "%%nql CREATE last\nSELECT * FROM broken\n")
+        failed = Pipeline.from_file(pipeline_session, sql_file).run()
+        assert failed["origin"].tolist() == [f"{sql_file} #1", f"{sql_file} #2", f"{sql_file} #3"]
+        assert failed["status"][0] == "built" and failed["status"][2] == "not run"
+        assert failed["status"][1].startswith("failed: OperationalError")
+
+        # each thread would have its own in memory database so the steps run on this one.
+        memory = noteql.Session(dburi="sqlite://")
+        assert Pipeline.from_file(memory, notebook, params={"start": 1}).run()["status"].tolist() == ["built"] * 4
+        assert memory.get_dataframe("SELECT b FROM latest")["b"].tolist() == [2]
+        del memory
+
+        ip.user_ns["session"].set()
+
+
+def test_postgres_show_statements(postgres_session):
+    # statements that are not queries can not be streamed in a server side cursor.
+    assert ip.run_cell_magic("nql", "", "CREATE TABLE shown AS SELECT 1 a") == [None]
+    assert ip.run_cell_magic("nql", "", "INSERT INTO shown VALUES (2)") == [None]
+    assert ip.run_cell_magic("nql", "", "SELECT * FROM shown ORDER BY a")[0]["a"].tolist() == [1, 2]
+    assert list(postgres_session.iter_dataframes("UPDATE shown SET a = a + 1")) == []
+    # nor can SELECT INTO or a WITH that changes rows.
+    assert ip.run_cell_magic("nql", "", "SELECT a INTO copied FROM shown") == [None]
+    dfs = ip.run_cell_magic("nql", "", "WITH deleted AS (DELETE FROM copied RETURNING a) SELECT a FROM deleted ORDER BY a")
+    assert dfs[0]["a"].tolist() == [2, 3]
+
+
+def test_postgres_returning(postgres_session, tmp_path):
+    postgres_session.get_results("CREATE TABLE items (id serial, name text)")
+    ip.run_cell_magic("nql", "new_id=CELL", "INSERT INTO items (name) VALUES ('first') RETURNING id")
+    assert ip.user_ns["new_id"] == 1
+    ip.run_cell_magic("nql", "new_row=ROW", "INSERT INTO items (name) VALUES ('second') RETURNING id, name")
+    assert ip.user_ns["new_row"] == [2, "second"]
+    out_xlsx = tmp_path / "returned.xlsx"
+    ip.run_cell_magic("nql", f"EXCEL {out_xlsx}", "INSERT INTO items (name) VALUES ('third') RETURNING id")
+    assert list(load_workbook(filename=out_xlsx)["Sheet"].values) == [("id",), (3,)]
+
+
+def test_postgres_csv(postgres_session, tmp_path):
+    sql = "SELECT true flag, timestamptz '2024-01-02 03:04:05+00' at_time, '{\"a\": 1}'::jsonb data"
+    # COPY writes the values as postgres does.
+    ip.run_cell_magic("nql", f"CSV {tmp_path / 'copy.csv'}", sql)
+    assert (tmp_path / "copy.csv").read_text() == 'flag,at_time,data\nt,2024-01-02 03:04:05+00,"{""a"": 1}"\n'
+    # fetched rows are written as python shows them.
+    ip.run_cell_magic("nql", f"CSV {tmp_path / 'rows.csv'} flag=CELL", sql)
+    assert (tmp_path / "rows.csv").read_text() == "flag,at_time,data\nTrue,2024-01-02 03:04:05+00:00,{'a': 1}\n"
+    # statements COPY can not run are written as COPY would write them.
+    postgres_session.get_results("CREATE TABLE flags (flag boolean, at_time timestamptz, data jsonb, note text, tags int[])")
+    ip.run_cell_magic("nql", f"CSV {tmp_path / 'returned.csv'}", (
+        "INSERT INTO flags VALUES (true, '2024-01-02 03:04:05+00', '{\"a\": 1}', '', '{1,2}'), (null, null, null, null, null) "
+        "RETURNING *"
+    ))
+    ip.run_cell_magic("nql", f"CSV {tmp_path / 'copied.csv'}", "SELECT * FROM flags")
+    assert (tmp_path / "returned.csv").read_text() == (tmp_path / "copied.csv").read_text() == (
+        'flag,at_time,data,note,tags\nt,2024-01-02 03:04:05+00,"{""a"": 1}","","{1,2}"\n,,,,\n'
+    )
+
+
+def test_postgres_matview(postgres_session):
+    postgres_session.get_results("CREATE TABLE source AS SELECT 1 a")
+    for command in ("CREATE", "VIEW"):
+        ip.run_cell_magic("nql", f"{command} totals", "SELECT a FROM source")
+        assert postgres_session.create_materialized_view("totals", "SELECT a FROM source", unique="a") == "Created"
+        kind = postgres_session.get_dataframe("SELECT relkind FROM pg_class WHERE oid = 'totals'::regclass")
+        assert kind["relkind"].tolist() == ["m"]
+    assert postgres_session.create_materialized_view("totals", "SELECT a FROM source", unique="a") == "Refreshed"
+    # and back again.
+    ip.run_cell_magic("nql", "VIEW totals", "SELECT a FROM source")
+    assert postgres_session.get_dataframe("SELECT relkind FROM pg_class WHERE oid = 'totals'::regclass")["relkind"].tolist() == ["v"]
+
+
+def test_postgres_incremental(postgres_session):
+    postgres_session.incremental = True
+    postgres_session.get_results("DROP TABLE IF EXISTS public.noteql_test_raw")
+    postgres_session.get_results("CREATE TABLE public.noteql_test_raw AS SELECT 1 a")
+    try:
+        sql = "SELECT a FROM public.noteql_test_raw"
+        assert postgres_session.create_table("from_public", sql) != "Skipped"
+        assert postgres_session.create_table("from_public", sql) == "Skipped"
+        postgres_session.get_results("INSERT INTO public.noteql_test_raw VALUES (2)")
+        assert postgres_session.create_table("from_public", sql) != "Skipped"
+    finally:
+        postgres_session.get_results("DROP TABLE public.noteql_test_raw")